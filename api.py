@@ -0,0 +1,176 @@
+# api.py
+'''
+JSON HTTP API for running the model from other software (e.g. farm management
+tools). It is served by the same process as the Shiny app (see app.py) and
+shares its worker pool and result cache, so identical requests from the app
+and the API are only run once.
+
+POST /api/evaluate with one scenario, or a list of scenarios to evaluate many
+animals in a single request:
+
+    {
+        "id": "cow 1",                          # optional, returned with the result
+        "diet": {"Corn silage, typical": 10, "Legume hay, mid-maturity": 8},
+        "animal_input": {"An_BW": 650},         # optional, changes from the app defaults
+        "equation_selection": {"mPrt_eqn": 1},  # optional
+        "feed_library": "NASEM",                # optional
+        "outputs": ["Mlk_Prod_comp"]            # optional, defaults to the Outputs tab variables
+    }
+
+Each scenario returns {"id", "status": "ok", "outputs": {variable: value}} or
+{"id", "status": "error", "error": message}. A list of scenarios returns a list
+of results in the same order, and errors in one scenario don't affect the others.
+
+GET /api/stats returns counters for the result cache ("cache") and the model
+runs started by this process ("runs"), including how many callers shared each
+run because they asked for identical inputs at the same time.
+'''
+import asyncio
+import math
+from typing import Callable
+
+import pandas as pd
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from model_runner import fingerprint_dataframe, run_nasem_async, env_int, model_cache, model_single_flight
+from utils import (
+    get_feed_library_default,
+    get_output_variables,
+    get_all_output_variables,
+    build_model_inputs,
+    get_model_values
+    )
+
+# Largest number of scenarios accepted in one request
+api_max_batch = env_int('NASEM_API_MAX_BATCH', 1000)
+
+
+################################################################################
+# Feed libraries
+################################################################################
+
+# Functions that load the libraries that requests can select by id
+_feed_library_loaders: dict[str, Callable[[], pd.DataFrame]] = {}
+# Loaded libraries, with their fingerprints
+_feed_libraries: dict[str, tuple[pd.DataFrame, str]] = {}
+
+
+def register_feed_library(library_id: str, load_feed_library: Callable[[], pd.DataFrame]) -> None:
+    '''
+    Makes a feed library available to API requests as `library_id`. 
+    The library is loaded when it is first requested.
+    '''
+    _feed_library_loaders[library_id] = load_feed_library
+    _feed_libraries.pop(library_id, None)
+
+
+def get_feed_library(library_id: str) -> tuple[pd.DataFrame, str]:
+    if not isinstance(library_id, str) or library_id not in _feed_library_loaders:
+        raise ValueError(
+            f"Unknown feed library '{library_id}', expected one of: {', '.join(_feed_library_loaders)}"
+            )
+    if library_id not in _feed_libraries:
+        feed_library = _feed_library_loaders[library_id]()
+        _feed_libraries[library_id] = (feed_library, fingerprint_dataframe(feed_library))
+    return _feed_libraries[library_id]
+
+
+default_feed_library_id = 'NASEM'
+register_feed_library(default_feed_library_id, get_feed_library_default)
+
+
+################################################################################
+# Evaluation
+################################################################################
+
+def get_requested_outputs(outputs) -> list:
+    '''
+    `outputs` can be a list of model variables, the name of a table from the
+    app (e.g. "milk", see get_output_variables()) or None for all of them.
+    '''
+    if outputs is None:
+        return get_all_output_variables()
+    if isinstance(outputs, str):
+        output_groups = get_output_variables()
+        if outputs not in output_groups:
+            raise ValueError(
+                f"Unknown outputs '{outputs}', expected a list of variables or one of: {', '.join(output_groups)}"
+                )
+        return output_groups[outputs]
+    if isinstance(outputs, list) and all(isinstance(var, str) for var in outputs):
+        return outputs
+    raise ValueError("outputs must be a list of variable names or the name of an output table")
+
+
+async def evaluate_scenario(scenario) -> dict:
+    '''Runs the model for one scenario from a request body'''
+    if not isinstance(scenario, dict):
+        return {'id': None, 'status': 'error', 'error': "Each scenario must be a JSON object"}
+
+    result = {'id': scenario.get('id')}
+    try:
+        user_diet, animal_input, equation_selection = build_model_inputs(
+            scenario.get('diet'),
+            scenario.get('animal_input'),
+            scenario.get('equation_selection')
+            )
+        feed_library, feed_library_fingerprint = get_feed_library(
+            scenario.get('feed_library', default_feed_library_id)
+            )
+        variables = get_requested_outputs(scenario.get('outputs'))
+
+        model_output = await run_nasem_async(
+            user_diet,
+            animal_input,
+            equation_selection,
+            feed_library,
+            feed_library_fingerprint
+            )
+
+    except Exception as e:
+        result.update(status='error', error=str(e))
+        return result
+
+    outputs = get_model_values(model_output, variables)
+    # JSON has no NaN or Infinity, so these are returned as null
+    outputs = {
+        var: value if value is None or math.isfinite(value) else None 
+        for var, value in outputs.items()
+    }
+    result.update(status='ok', outputs=outputs)
+    return result
+
+
+async def evaluate(request: Request) -> JSONResponse:
+    try:
+        body = await request.json()
+    except ValueError:
+        return JSONResponse({'error': "Request body must be JSON"}, status_code=400)
+
+    if isinstance(body, list):
+        if len(body) > api_max_batch:
+            return JSONResponse(
+                {'error': f"Too many scenarios ({len(body)}), the limit is {api_max_batch} per request"},
+                status_code=413
+                )
+        # All scenarios are submitted to the worker pool at once
+        results = await asyncio.gather(*(evaluate_scenario(scenario) for scenario in body))
+        return JSONResponse(results)
+
+    result = await evaluate_scenario(body)
+    return JSONResponse(result, status_code=200 if result['status'] == 'ok' else 400)
+
+
+async def stats(request: Request) -> JSONResponse:
+    return JSONResponse({
+        'cache': model_cache.stats(),
+        'runs': model_single_flight.stats(),
+    })
+
+
+api_routes = [
+    Route('/api/evaluate', evaluate, methods=['POST']),
+    Route('/api/stats', stats, methods=['GET']),
+]
@@ -4,9 +4,12 @@ from shiny import App, reactive, render, ui, req
 import shiny.experimental as x
 # from shinywidgets import output_widget, render_widget, reactive_read
 from datetime import date
+import asyncio
 import pandas as pd
 from pathlib import Path
 import shinyswatch
+from starlette.applications import Starlette
+from starlette.routing import Mount
 # import pdb #like browser()
 
 from version import __version__
@@ -17,16 +20,19 @@ from faicons import icon_svg
 # from ipydatagrid import DataGrid
 
 
-# pip install git+https://github.com/CNM-University-of-Guelph/NASEM-Model-Python
-import nasem_dairy as nd
-
-from utils import (feed_library_default)
+from utils import (get_feed_library_default, debounce)
+from model_runner import fingerprint_dataframe, fingerprint_model_inputs, run_nasem_async, env_int, ModelRunTracker
+from model_values import ModelValues
+from api import api_routes
 # modules
 from module_feed_library import feed_library_ui, feed_library_server
 from module_inputs import animal_inputs_ui, animal_inputs_server
 from module_outputs import outputs_ui, outputs_server
 from module_diet import diet_ui, diet_server
 
+# Milliseconds to wait for inputs to stop changing before running the model
+model_debounce_ms = env_int('NASEM_MODEL_DEBOUNCE_MS', 400)
+
 
 ################################################################################
 # Shiny App
@@ -101,6 +107,7 @@ app_ui = ui.page_navbar(
             outputs_ui('nav_outputs')
             ), 
     ui.nav_spacer(), 
+    ui.nav_control(ui.output_ui('model_status')),
     ui.nav_control(f"version: {__version__}"),
     ui.nav_control(ui.input_dark_mode()), 
 
@@ -151,7 +158,7 @@ def server(input, output, session):
     # Animal inputs
     #######################################################
     nav_diet_ns = session.ns('nav_diet')
-    animal_input_dict, animal_input_reactives, equation_selection, usr_session_lib, session_upload_ModelOuput = animal_inputs_server(
+    animal_input_dict, animal_input_reactives, equation_selection, usr_session_lib, session_upload_diet, session_restored = animal_inputs_server(
         'nav_inputs', 
         input[nav_diet_ns("DMI")]
         )   
@@ -162,12 +169,17 @@ def server(input, output, session):
     #######################################################  
     user_selected_feed_library, user_selected_feeds = feed_library_server(
         "nav_feed_library", 
-        feed_library_initial= feed_library_default, 
+        feed_library_initial= get_feed_library_default(), 
         user_selections_reset = input.reset_user_selected_feed_names,
         session_upload_library = usr_session_lib
         )
         
 
+    @reactive.Calc
+    def feed_library_fingerprint():
+        '''Hashed once per library so that each model run only hashes the diet and inputs'''
+        return fingerprint_dataframe(user_selected_feed_library())
+
     #######################################################################
     # Model execution
     # Note: The order of operations matters here because the
@@ -175,9 +187,10 @@ def server(input, output, session):
     # i.e. NASEM_out reactive needs to be before Diet module in this file
     #######################################################################
     @reactive.Calc
-    def NASEM_out():
-        # Require that diet has > 0 kg before proceeding
-        req( diet_total_intake() > 0)  
+    def current_model_inputs():
+        # None when the diet is empty, which clears the outputs (see nasem_task)
+        if diet_total_intake() <= 0:
+            return None
         
         # modify input.DMIn_eqn() to be 0 for model, force 'target' DMI when running model
         modified_equation_selection = equation_selection().copy()
@@ -187,15 +200,109 @@ def server(input, output, session):
         # modified_equation_selection['mFat_eqn'] = 1
 
         # modified_equation_selection['mProd_eqn'] = 1 Defaults to 'component based'
-    
-        model_output = nd.nasem(
+
+        return (
             user_diet(), 
-            animal_input_dict().copy(), 
+            animal_input_dict(), 
             modified_equation_selection, 
             user_selected_feed_library(), 
+            feed_library_fingerprint()
             )
+
+    # Edits are coalesced so that a burst of changes (e.g. typing kg values) 
+    # produces a single model run with the final values
+    model_inputs = debounce(model_debounce_ms / 1000)(current_model_inputs)
+
+    # Only the newest run is allowed to drive the outputs
+    run_tracker = ModelRunTracker()
+
+    # Counts the times the inputs returned to those of the newest run, which
+    # isn't run again. The Diet tab then replaces its preview of the diet
+    # composition with that run's output (see diet_server())
+    model_run_repeated = reactive.Value(0)
+
+    @reactive.extended_task
+    async def nasem_task(generation, inputs):
+        try:
+            if inputs is None:
+                # The diet is empty, so there is nothing to show rather than the last run
+                return None
+
+            # Runs in the worker pool so other sessions aren't blocked while the model runs.
+            # Identical inputs (from any session) return the cached ModelOutput
+            model_output = await run_nasem_async(*inputs)
+        finally:
+            run_tracker.finish(generation)
         
+        if not run_tracker.is_current(generation):
+            # Inputs changed while this run was executing, so nobody will see it
+            raise asyncio.CancelledError()
         return model_output
+
+    def run_model(inputs):
+        # (user diet, animal input, equation selection, feed library fingerprint),
+        # or None for an empty diet
+        inputs_key = None if inputs is None else fingerprint_model_inputs(*inputs[:3], inputs[4])
+        if inputs_key == run_tracker.inputs_key:
+            # e.g. the debounced inputs catching up with a restored session
+            with reactive.isolate():
+                model_run_repeated.set(model_run_repeated() + 1)
+            return
+        generation = run_tracker.next_generation(inputs_key)
+
+        # Supersede a run that is still in progress, rather than queueing behind 
+        # it and rendering its (stale) result first
+        nasem_task.cancel()
+        nasem_task.invoke(generation, inputs)
+
+    @reactive.effect
+    def _():
+        inputs = model_inputs()
+        with reactive.isolate():
+            if not session_restored():
+                # Half of a session file's inputs may have been applied
+                return
+        run_model(inputs)
+
+    @reactive.effect
+    @reactive.event(session_restored, ignore_init=True)
+    def _():
+        '''Runs the model once, with all of the inputs from a session file'''
+        if session_restored():
+            run_model(current_model_inputs())
+
+    def model_running():
+        '''
+        True while a run is in progress. A superseded run ends as 'cancelled'
+        just before the newest run starts, which still counts as running.
+        '''
+        status = nasem_task.status()
+        return status == 'running' or (status == 'cancelled' and run_tracker.is_pending())
+
+    @reactive.Calc
+    def NASEM_out():
+        # While a run is in progress, this puts dependent outputs into a 'calculating' state.
+        # Only changes when a run starts or finishes, not with each edit of the diet.
+        # The result is None (clearing the outputs) when the diet is empty.
+        if model_running():
+            req(False, cancel_output='progress')
+        return req(nasem_task.result())
+
+    @reactive.Calc
+    def model_values():
+        # All values are extracted from the model output once per run for the
+        # tables on the Diet and Outputs tabs, see model_values.py
+        return ModelValues(NASEM_out())
+    
+    @render.ui
+    def model_status():
+        if model_running():
+            return ui.span(
+                icon_svg('spinner', margin_right='5px'), 
+                'Calculating...', 
+                class_ = 'model-status'
+                )
+        return ui.TagList()
     
 
     #######################################################
@@ -206,12 +313,14 @@ def server(input, output, session):
         diet_server(
             'nav_diet',                
             NASEM_out = NASEM_out, 
+            model_values = model_values,
+            model_run_repeated = model_run_repeated,
             animal_input_dict = animal_input_dict, 
             # equation_selection = equation_selection,
             animal_input_reactives = animal_input_reactives,
             user_selected_feed_library = user_selected_feed_library,
             user_selected_feeds = user_selected_feeds,
-            session_upload_ModOut = session_upload_ModelOuput
+            session_upload_diet = session_upload_diet
         )
     ) 
     #######################################################
@@ -219,6 +328,7 @@ def server(input, output, session):
     #######################################################
     outputs_server('nav_outputs', 
         NASEM_out, 
+        model_values,
         user_selected_feed_library, 
         animal_input_dict,
         df_model_snapshot
@@ -252,4 +362,7 @@ def server(input, output, session):
 
 
 app_dir = Path(__file__).parent
-app = App(app_ui, server, static_assets=app_dir / "www", debug=False)
\ No newline at end of file
+shiny_app = App(app_ui, server, static_assets=app_dir / "www", debug=False)
+
+# The JSON API (see api.py) is served next to the app and shares its model cache
+app = Starlette(routes=[*api_routes, Mount('/', app=shiny_app)])
\ No newline at end of file
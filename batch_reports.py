@@ -0,0 +1,301 @@
+# batch_reports.py
+'''
+Write the summary and full reports for many scenarios without the Shiny UI.
+
+Scenarios are either a directory of .NDsession files (downloaded from the
+Outputs tab) or a scenario table in the format used by batch_runner.py. Each
+scenario is evaluated first, except for older session files, which already
+contain a model output. For each scenario,
+`<id>-summary.html` and `<id>-full.html` are written to the output directory,
+the same as the report downloads on the Outputs tab, with an `index.html`
+linking to every report.
+
+Scenarios are run and their reports written in parallel across all cores.
+Tables that are the same in many reports (e.g. the equation selections) are
+converted to HTML once per worker.
+
+Example:
+    python batch_reports.py sessions/ reports/ --workers 8
+    python batch_reports.py scenarios.csv reports/ --diets diets.csv
+'''
+import argparse
+import html
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+import nasem_dairy as nd
+
+from batch_runner import iter_scenario_rows, read_diets, prepare_scenario, init_worker, run_scenario_model
+from generate_report import (
+    summary_report_tables,
+    iter_summary_report,
+    iter_full_report,
+    full_report_table_names,
+    table_to_html
+    )
+from model_runner import fingerprint_dataframe, execute_nasem
+from model_values import ModelValues
+from session_file import read_session
+from utils import (
+    display_diet_values,
+    get_output_variables,
+    get_model_snapshot,
+    compare_animal_inputs,
+    default_feed_library_path
+    )
+
+
+################################################################################
+# Reading scenarios
+################################################################################
+
+def iter_report_jobs(scenarios_path: Path, diets_path: Path | None = None):
+    '''
+    Yields (scenario_id, job) for each scenario, where job is a session file
+    path or a scenario from prepare_scenario(). A job is an Exception if the
+    scenario can't be read.
+    '''
+    if scenarios_path.is_dir():
+        for path in sorted(scenarios_path.glob('*.NDsession')):
+            yield path.stem, path
+        return
+
+    diets = read_diets(diets_path) if diets_path is not None else None
+    for row_number, row in enumerate(iter_scenario_rows(scenarios_path), start=1):
+        try:
+            scenario = prepare_scenario(row, row_number, diets)
+        except Exception as e:
+            yield str(row.get('scenario_id', row_number)), e
+            continue
+        yield scenario['scenario_id'], scenario
+
+
+def report_file_stem(scenario_id: str, used: set) -> str:
+    '''A file name for the reports of `scenario_id` that isn't in `used`'''
+    stem = re.sub(r'[^\w.-]+', '_', scenario_id).strip('._') or 'scenario'
+    unique_stem, n = stem, 1
+    while unique_stem.lower() in used:
+        n += 1
+        unique_stem = f"{stem}_{n}"
+    used.add(unique_stem.lower())
+    return unique_stem
+
+
+################################################################################
+# Worker processes
+################################################################################
+
+# HTML of tables already converted by this worker, by fingerprint
+_shared_tables = {}
+max_shared_tables = 1000
+
+
+def shared_table_to_html(df: pd.DataFrame) -> str:
+    '''table_to_html(), converting each distinct table only once per worker'''
+    try:
+        key = fingerprint_dataframe(df)
+    except TypeError:
+        # e.g. unhashable values
+        return table_to_html(df)
+
+    table_html = _shared_tables.get(key)
+    if table_html is None:
+        if len(_shared_tables) >= max_shared_tables:
+            _shared_tables.clear()
+        table_html = _shared_tables[key] = table_to_html(df)
+    return table_html
+
+
+def report_summary_tables(model_output: nd.ModelOutput, animal_input: dict) -> dict:
+    '''
+    The HTML tables of the summary report, made the same way as on the
+    Outputs tab (see outputs_server() in module_outputs.py).
+    '''
+    model_values = ModelValues(model_output)
+    output_variables = get_output_variables()
+
+    return summary_report_tables(
+        df_milk=model_values.get_vars_as_df(output_variables['milk']),
+        df_allowable_milk=model_values.get_vars_as_df(output_variables['allowable_milk']),
+        df_ME=model_values.get_vars_as_df(output_variables['ME']),
+        df_MP=model_values.get_vars_as_df(output_variables['MP']),
+        df_diet_summary=display_diet_values(model_values),
+        df_NEL=model_values.get_vars_as_df(output_variables['NEL']),
+        df_DCAD=model_values.get_vars_as_df(output_variables['DCAD']),
+        df_ration_ingredients=model_output.get_value('user_diet'),
+        df_energy_teaching=model_values.get_vars_as_df(output_variables['energy_teaching']),
+        df_animal_input_comparison=compare_animal_inputs(animal_input, model_output),
+        dict_equation_selections=model_output.get_value('equation_selection'),
+        df_snapshot=get_model_snapshot(model_values, model_output.get_value('An_StatePhys')),
+        table_html=shared_table_to_html
+        )
+
+
+def write_reports(scenario_id: str, job, output_dir: Path, stem: str) -> dict:
+    '''
+    Runs the model for a scenario if needed, and writes its summary and full
+    reports. Errors are returned in the result rather than raised, so that one
+    bad scenario doesn't stop the batch.
+    '''
+    result = {'scenario_id': scenario_id, 'status': 'ok', 'error': '', 'stem': stem, 'milk': None}
+    try:
+        if isinstance(job, Exception):
+            raise job
+        if isinstance(job, Path):
+            session = read_session(job.read_bytes())
+            for warning in session['Warnings']:
+                print(f"{job.name}: {warning}", file=sys.stderr)
+            # Only older session files have a model output
+            model_output = session.get('ModelOutput')
+            if model_output is None:
+                model_output = execute_nasem(
+                    session['user_diet'],
+                    session['animal_input'],
+                    session['equation_selection'],
+                    session['FeedLibrary']
+                    )
+            animal_input = session['animal_input']
+        else:
+            model_output = run_scenario_model(job)
+            animal_input = job['animal_input']
+
+        tables = report_summary_tables(model_output, animal_input)
+        # Reports are written as they are made, rather than held in memory
+        with open(output_dir / f"{stem}-summary.html", 'w', encoding='utf-8') as f:
+            f.writelines(iter_summary_report(tables))
+        with open(output_dir / f"{stem}-full.html", 'w', encoding='utf-8') as f:
+            f.writelines(iter_full_report(model_output, full_report_table_names))
+
+        result['milk'] = float(model_output.get_value('Mlk_Prod_comp'))
+
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+
+    return result
+
+
+################################################################################
+# Index page
+################################################################################
+
+def write_index(path: Path, results: list):
+    '''Writes an HTML page linking to the reports of each scenario'''
+    rows = []
+    for result in results:
+        stem = html.escape(result['stem'])
+        reports = (
+            f'<a href="{stem}-summary.html">Summary</a> | <a href="{stem}-full.html">Full</a>'
+            if result['status'] == 'ok' else ''
+            )
+        rows.append({
+            'Scenario': html.escape(result['scenario_id']),
+            'Reports': reports,
+            'Milk (kg/d)': result['milk'],
+            'Error': html.escape(result['error']),
+            })
+
+    df = pd.DataFrame(rows, columns=['Scenario', 'Reports', 'Milk (kg/d)', 'Error'])
+    table = table_to_html(df, index=False, escape=False, na_rep='', float_format='{:.4g}'.format)
+    n_errors = sum(result['status'] == 'error' for result in results)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"""
+    <html>
+    <head>
+        <title>NASEM Reports</title>
+        <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
+    </head>
+    <body>
+        <div class="container">
+            <h1>NASEM 2021 - Reports</h1>
+            <p>{len(results)} scenarios ({n_errors} errors)</p>
+            <div class="table-responsive">
+                {table}
+            </div>
+        </div>
+    </body>
+    </html>
+    """)
+
+
+################################################################################
+# Batch execution
+################################################################################
+
+def run_batch_reports(scenarios_path: Path,
+                      output_dir: Path,
+                      diets_path: Path | None = None,
+                      feed_library_path: Path = default_feed_library_path,
+                      workers: int | None = None) -> dict:
+    '''
+    Writes the reports for every scenario in `scenarios_path` (a directory of
+    .NDsession files or a scenario table) to `output_dir` in a pool of worker
+    processes, then writes the index page. Returns a count of successful and
+    failed scenarios.
+    '''
+    workers = workers or os.cpu_count() or 1
+    output_dir.mkdir(parents=True, exist_ok=True)
+    counts = {'ok': 0, 'error': 0}
+    # {position in the scenarios: result}
+    results = {}
+    used_stems = {'index'}
+    start = time.time()
+
+    # Limit the number of scenarios waiting in the pool so memory stays flat
+    max_pending = workers * 4
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(str(feed_library_path),)
+    ) as executor:
+        pending = {}
+
+        def collect_completed(done):
+            for future in done:
+                result = future.result()
+                results[pending.pop(future)] = result
+                counts[result['status']] += 1
+            n_done = counts['ok'] + counts['error']
+            if n_done % 10 < len(done):
+                print(f"{n_done} scenarios reported ({time.time() - start:.1f} s)", file=sys.stderr)
+
+        for order, (scenario_id, job) in enumerate(iter_report_jobs(scenarios_path, diets_path)):
+            stem = report_file_stem(scenario_id, used_stems)
+            pending[executor.submit(write_reports, scenario_id, job, output_dir, stem)] = order
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect_completed(done)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect_completed(done)
+
+    # The index lists scenarios in the order they were given
+    write_index(output_dir / 'index.html', [results[order] for order in sorted(results)])
+
+    print(f"Finished {counts['ok'] + counts['error']} scenarios ({counts['error']} errors) in {time.time() - start:.1f} s", file=sys.stderr)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', type=Path, help='Directory of .NDsession files, or a scenario table (.csv or .parquet)')
+    parser.add_argument('output', type=Path, help='Directory to write the reports to')
+    parser.add_argument('--diets', type=Path, help='Long-format diet table (scenario_id, Feedstuff, kg_user)')
+    parser.add_argument('--feed-library', type=Path, default=default_feed_library_path, help='Feed library .csv used for scenario tables (defaults to the NASEM library)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (defaults to the number of CPUs)')
+    args = parser.parse_args(argv)
+
+    counts = run_batch_reports(args.scenarios, args.output, args.diets, args.feed_library, args.workers)
+    return 1 if counts['error'] and not counts['ok'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
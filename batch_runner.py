@@ -0,0 +1,301 @@
+# batch_runner.py
+'''
+Run many model scenarios without the Shiny UI.
+
+Each row of the scenario table (.csv or .parquet) is one scenario. Columns can be:
+- `scenario_id`: an identifier copied to the results (defaults to the row number)
+- any animal input used by the model (e.g. An_BW, Trg_MilkProd, An_StatePhys)
+- any equation selection (e.g. mPrt_eqn, MiN_eqn)
+- `diet`: a JSON object of feed names and kg DM, e.g. {"Corn silage, typical": 9, "Urea": 0.15}
+
+Inputs that aren't given use the app defaults (see get_default_animal_input()).
+Trg_Dt_DMIn defaults to the total kg DM of the diet. Instead of a `diet` column,
+diets can be supplied in a separate long-format table with the columns
+scenario_id, Feedstuff and kg_user using --diets.
+
+Scenarios are evaluated in parallel across all cores and the results (the
+variables shown in the app's Outputs tab) are written to disk as each
+scenario finishes, so memory use does not grow with the number of scenarios.
+
+Example:
+    python batch_runner.py scenarios.csv results.csv --workers 8
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+
+from model_runner import execute_nasem
+from utils import (
+    get_all_output_variables,
+    get_default_equation_selection,
+    build_model_inputs,
+    get_model_values,
+    default_feed_library_path
+    )
+from data_loader import read_csv_cached
+
+
+################################################################################
+# Reading scenarios
+################################################################################
+
+def iter_scenario_rows(path: Path, chunksize: int = 1000):
+    '''
+    Yields each scenario as a dictionary, reading the file in chunks so that
+    large tables are never fully loaded into memory.
+    '''
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield from batch.to_pylist()
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            yield from chunk.to_dict(orient='records')
+
+
+def read_diets(path: Path) -> dict:
+    '''
+    Reads a long-format diet table (scenario_id, Feedstuff, kg_user) into a
+    dictionary of {scenario_id: {Feedstuff: kg_user}}.
+    '''
+    df = pd.read_parquet(path) if path.suffix == '.parquet' else pd.read_csv(path)
+    missing = {'scenario_id', 'Feedstuff', 'kg_user'}.difference(df.columns)
+    if missing:
+        raise ValueError(f"Diet table is missing columns: {', '.join(sorted(missing))}")
+
+    return {
+        str(scenario_id): dict(zip(group['Feedstuff'], group['kg_user']))
+        for scenario_id, group in df.groupby('scenario_id', sort=False)
+    }
+
+
+def prepare_scenario(row: dict, row_number: int, diets: dict | None = None) -> dict:
+    '''
+    Splits a scenario row into the inputs required by nd.nasem(), filling any
+    missing values with the app defaults.
+    '''
+    # Empty cells are read as NaN, treat them as not given
+    row = {k: v for k, v in row.items() if not (isinstance(v, float) and pd.isna(v))}
+    scenario_id = str(row.pop('scenario_id', row_number))
+
+    if 'diet' in row:
+        diet = row.pop('diet')
+        diet = json.loads(diet) if isinstance(diet, str) else diet
+    elif diets is not None and scenario_id in diets:
+        diet = diets[scenario_id]
+    else:
+        raise ValueError(f"No diet given for scenario {scenario_id}")
+
+    equation_keys = get_default_equation_selection().keys()
+    animal_input = {k: v for k, v in row.items() if k not in equation_keys}
+    equation_selection = {k: v for k, v in row.items() if k in equation_keys}
+
+    try:
+        user_diet, animal_input, equation_selection = build_model_inputs(
+            diet, animal_input, equation_selection
+            )
+    except ValueError as e:
+        raise ValueError(f"Scenario {scenario_id}: {e}") from e
+
+    return {
+        'scenario_id': scenario_id,
+        'user_diet': user_diet,
+        'animal_input': animal_input,
+        'equation_selection': equation_selection,
+    }
+
+
+################################################################################
+# Worker processes
+################################################################################
+
+# Set in each worker by init_worker() so the library is only sent once per worker
+_worker_feed_library = None
+
+
+def init_worker(feed_library_path: str):
+    global _worker_feed_library
+    # The model warns about divisions by zero for diets without some nutrients,
+    # which would otherwise flood the output for large batches
+    warnings.simplefilter('ignore', RuntimeWarning)
+    _worker_feed_library = read_csv_cached(feed_library_path, sort_by='Fd_Name')
+
+
+def get_result_columns() -> list:
+    return ['scenario_id', 'status', 'error'] + get_all_output_variables()
+
+
+def run_scenario_model(scenario: dict):
+    '''
+    Runs the model for a scenario from prepare_scenario(), in a worker. The
+    app's result cache isn't used, as each scenario is only run once.
+    '''
+    return execute_nasem(
+        scenario['user_diet'],
+        scenario['animal_input'],
+        scenario['equation_selection'],
+        _worker_feed_library
+        )
+
+
+def evaluate_scenario(scenario: dict) -> dict:
+    '''
+    Runs the model for one scenario and returns a flat dictionary of results.
+    Errors are returned in the result rather than raised, so that one bad
+    scenario doesn't stop the batch.
+    '''
+    result = {'scenario_id': scenario['scenario_id'], 'status': 'ok', 'error': ''}
+    try:
+        model_output = run_scenario_model(scenario)
+        result.update(get_model_values(model_output, get_result_columns()[3:]))
+
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+
+    return result
+
+
+################################################################################
+# Writing results
+################################################################################
+
+class CSVResultWriter:
+    def __init__(self, path: Path, columns: list):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction='ignore')
+        self._writer.writeheader()
+
+    def write(self, result: dict):
+        self._writer.writerow(result)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    '''Parquet is written in row groups, so results are buffered until `batch_size` rows'''
+    def __init__(self, path: Path, columns: list, batch_size: int = 1000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._columns = columns
+        self._schema = pa.schema(
+            [(col, pa.string()) for col in columns[:3]]
+            + [(col, pa.float64()) for col in columns[3:]]
+            )
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._batch_size = batch_size
+        self._rows = []
+
+    def write(self, result: dict):
+        self._rows.append(result)
+        if len(self._rows) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            table = self._pa.Table.from_pylist(self._rows, schema=self._schema)
+            self._writer.write_table(table)
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def get_result_writer(path: Path, columns: list):
+    if path.suffix == '.parquet':
+        return ParquetResultWriter(path, columns)
+    return CSVResultWriter(path, columns)
+
+
+################################################################################
+# Batch execution
+################################################################################
+
+def run_batch(scenarios_path: Path,
+              output_path: Path,
+              diets_path: Path | None = None,
+              feed_library_path: Path = default_feed_library_path,
+              workers: int | None = None) -> dict:
+    '''
+    Evaluates every scenario in `scenarios_path` in a pool of worker processes
+    and streams the results to `output_path` in the order they finish.
+    Returns a count of successful and failed scenarios.
+    '''
+    workers = workers or os.cpu_count() or 1
+    diets = read_diets(diets_path) if diets_path is not None else None
+    columns = get_result_columns()
+    counts = {'ok': 0, 'error': 0}
+    start = time.time()
+
+    # Limit the number of scenarios waiting in the pool so memory stays flat
+    max_pending = workers * 4
+    writer = get_result_writer(output_path, columns)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(str(feed_library_path),)
+        ) as executor:
+            pending = set()
+
+            def write_completed(done):
+                for future in done:
+                    result = future.result()
+                    writer.write(result)
+                    counts[result['status']] += 1
+                n_done = counts['ok'] + counts['error']
+                if n_done % 500 < len(done):
+                    print(f"{n_done} scenarios evaluated ({time.time() - start:.1f} s)", file=sys.stderr)
+
+            for row_number, row in enumerate(iter_scenario_rows(scenarios_path), start=1):
+                try:
+                    scenario = prepare_scenario(row, row_number, diets)
+                except Exception as e:
+                    writer.write({'scenario_id': str(row.get('scenario_id', row_number)), 'status': 'error', 'error': str(e)})
+                    counts['error'] += 1
+                    continue
+
+                pending.add(executor.submit(evaluate_scenario, scenario))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write_completed(done)
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_completed(done)
+    finally:
+        writer.close()
+
+    print(f"Finished {counts['ok'] + counts['error']} scenarios ({counts['error']} errors) in {time.time() - start:.1f} s", file=sys.stderr)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', type=Path, help='Scenario table (.csv or .parquet)')
+    parser.add_argument('output', type=Path, help='Results file (.csv or .parquet)')
+    parser.add_argument('--diets', type=Path, help='Long-format diet table (scenario_id, Feedstuff, kg_user)')
+    parser.add_argument('--feed-library', type=Path, default=default_feed_library_path, help='Feed library .csv (defaults to the NASEM library)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (defaults to the number of CPUs)')
+    args = parser.parse_args(argv)
+
+    counts = run_batch(args.scenarios, args.output, args.diets, args.feed_library, args.workers)
+    return 1 if counts['error'] and not counts['ok'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# data_loader.py
+'''
+Reads the app's CSV data files (e.g. the feed library) through a binary cache.
+
+The first time a CSV is read, the parsed DataFrame is saved in the cache
+directory as an uncompressed Arrow IPC (Feather) file. Later reads memory-map that file, so
+numeric columns are used directly from the operating system's page cache
+without parsing or copying. Every worker process on a host that loads the same
+library shares one copy in memory. The cache records the size, modification
+time and hash of the CSV it was made from and is rebuilt when the CSV changes.
+
+The numeric columns of a memory-mapped DataFrame are read-only. Derived
+frames (e.g. selected rows or columns) are ordinary copies, but writing into
+the returned DataFrame in place raises an error, so callers that need to
+modify it must copy it first.
+
+The cache directory is set with NASEM_DATA_CACHE_DIR (defaults to
+`nasem-shiny` in the user's cache directory). It is kept out of www/ so that
+the caches aren't served with the app's static files. If the cache can't be
+written (e.g. a read-only file system) the CSV is used.
+'''
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+# Increase to rebuild existing caches, e.g. if the way they are written changes
+_cache_version = '2'
+
+
+def get_cache_dir() -> Path:
+    cache_dir = os.environ.get('NASEM_DATA_CACHE_DIR')
+    if cache_dir:
+        return Path(cache_dir)
+    user_cache_dir = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(user_cache_dir) / 'nasem-shiny'
+
+
+def get_cache_path(csv_path: Path) -> Path:
+    # Named after the CSV's full path, so CSVs with the same name don't share a cache
+    path_hash = hashlib.blake2b(str(csv_path.resolve()).encode(), digest_size=8).hexdigest()
+    return get_cache_dir() / f'{csv_path.stem}-{path_hash}.feather'
+
+
+def _hash_file(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _source_metadata(csv_path: Path, source_hash: str, sort_by: str | None) -> dict:
+    stat = csv_path.stat()
+    return {
+        'cache_version': _cache_version,
+        'source_size': str(stat.st_size),
+        'source_mtime_ns': str(stat.st_mtime_ns),
+        'source_hash': source_hash,
+        'sort_by': sort_by or '',
+    }
+
+
+def _read_cache_metadata(cache_path: Path) -> dict | None:
+    '''Reads the metadata of a cache file, without loading the data'''
+    try:
+        with pa.memory_map(str(cache_path)) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    return {k.decode(): v.decode() for k, v in metadata.items()}
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    # Arrow stores NaN as null by default, which would need a copy to convert
+    # back to NaN. Keeping them as float values allows zero-copy reads.
+    for i, name in enumerate(table.column_names):
+        if name in df.columns and df[name].dtype.kind == 'f':
+            table = table.set_column(i, name, pa.array(df[name].to_numpy(), from_pandas=False))
+    return table
+
+
+def _read_mapped(cache_path: Path) -> pd.DataFrame:
+    table = feather.read_table(cache_path, memory_map=True)
+    # split_blocks keeps each column as its own block, so that numeric columns
+    # are views of the memory map rather than being copied into 2D blocks
+    df = table.to_pandas(split_blocks=True)
+    # Arrow returns missing strings as None, where pd.read_csv() uses NaN
+    text_cols = df.select_dtypes('object').columns
+    if len(text_cols):
+        df[text_cols] = df[text_cols].where(df[text_cols].notna(), np.nan)
+    return df
+
+
+def _write_cache(table: pa.Table, cache_path: Path) -> None:
+    '''
+    Writes to a temporary file that is then renamed, so that other workers
+    starting at the same time never read a partly written cache. Processes
+    that have mapped the old file keep using it until they close it.
+    '''
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f'.{cache_path.name}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        # Compressed files can't be memory-mapped without decompressing
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _try_write_cache(table: pa.Table,
+                     csv_path: Path,
+                     cache_path: Path,
+                     source_hash: str,
+                     sort_by: str | None) -> bool:
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        **_source_metadata(csv_path, source_hash, sort_by)
+        })
+    try:
+        _write_cache(table, cache_path)
+    except (OSError, pa.ArrowException) as e:
+        print(f"Could not write cache for {csv_path.name}, reading from CSV: {e}")
+        return False
+    return True
+
+
+def read_csv_cached(csv_path: str | Path, sort_by: str | None = None) -> pd.DataFrame:
+    '''
+    Returns the same DataFrame as pd.read_csv(csv_path).sort_values(sort_by),
+    memory-mapped from the binary cache when the CSV hasn't changed.
+    The cache is created or updated when it's missing or out of date.
+
+    Sorting is done before the cache is written, as sorting a memory-mapped
+    DataFrame would copy it.
+    '''
+    csv_path = Path(csv_path)
+    cache_path = get_cache_path(csv_path)
+    metadata = _read_cache_metadata(cache_path)
+    stat = csv_path.stat()
+
+    if (metadata is not None
+            and metadata.get('cache_version') == _cache_version
+            and metadata.get('sort_by') == (sort_by or '')):
+        if (metadata.get('source_size') == str(stat.st_size)
+                and metadata.get('source_mtime_ns') == str(stat.st_mtime_ns)):
+            return _read_mapped(cache_path)
+
+        # The CSV was touched (e.g. by git checkout), check if its contents changed
+        source_hash = _hash_file(csv_path)
+        if metadata.get('source_hash') == source_hash:
+            table = feather.read_table(cache_path)
+            if _try_write_cache(table, csv_path, cache_path, source_hash, sort_by):
+                return _read_mapped(cache_path)
+    else:
+        source_hash = _hash_file(csv_path)
+
+    df = pd.read_csv(csv_path)
+    if sort_by is not None:
+        df = df.sort_values(sort_by)
+
+    if _try_write_cache(_to_arrow(df), csv_path, cache_path, source_hash, sort_by):
+        return _read_mapped(cache_path)
+    return df
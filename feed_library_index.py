@@ -0,0 +1,83 @@
+# feed_library_index.py
+'''
+Pre-computed column groups and row filters for viewing a feed library.
+
+The Feed Library tab shows groups of columns (amino acids, minerals, etc.) and
+can hide calf feeds. Rather than searching column labels and feed names each
+time a view setting changes, the positions are found once per library and each
+view is a single `iloc`.
+'''
+import numpy as np
+import pandas as pd
+
+from utils import get_teaching_feeds
+
+# Columns shown for each view setting, as a list of columns or a (first, last) range.
+# Groups are shown in this order, with columns already shown by an earlier group skipped.
+column_groups = {
+    'id': ['Fd_Name', 'Fd_Category', 'Fd_Type'],
+    'common': [
+        'Fd_DM', 'Fd_DE_Base', 'Fd_ADF', 'Fd_NDF', 'Fd_DNDF48_NDF', 'Fd_CP',
+        'Fd_RUP_base', 'Fd_NPN_CP', 'Fd_Ash', 'Fd_Ca', 'Fd_P', 'Fd_Mg', 'Fd_K'
+        ],
+    'amino_acids': ('Fd_Arg_CP', 'Fd_Val_CP'),
+    'fatty_acids': ('Fd_CFat', 'Fd_OtherFA_FA'),
+    'vitamins': ('Fd_B_Carotene', 'Fd_VitE'),
+    'minerals': ('Fd_Ca', 'Fd_Zn'),
+}
+
+# Columns within a range that aren't part of the group
+_excluded_from_group = {
+    'fatty_acids': ['Fd_Ash'],
+}
+
+
+class FeedLibraryIndex:
+    '''
+    Column positions of each group in `column_groups` and row positions for
+    filtering a feed library (with 'Fd_' column names). Positions also apply
+    to the same library after its columns are renamed (see rename_df_cols_Fd_to_feed()).
+    '''
+    def __init__(self, feed_library: pd.DataFrame):
+        columns = feed_library.columns
+        self.n_columns = len(columns)
+
+        self.group_positions = {}
+        for group, cols in column_groups.items():
+            if isinstance(cols, tuple):
+                first, last = cols
+                positions = range(columns.get_loc(first), columns.get_loc(last) + 1)
+            else:
+                positions = [columns.get_loc(col) for col in cols]
+            excluded = {columns.get_loc(col) for col in _excluded_from_group.get(group, [])}
+            self.group_positions[group] = [i for i in positions if i not in excluded]
+
+        fd_name = feed_library['Fd_Name']
+        is_calf_feed = (
+            (feed_library['Fd_Category'] == 'Calf Liquid Feed')
+            | fd_name.str.contains('Calf', case=False, na=False)
+            ).to_numpy()
+        self.non_calf_rows = np.flatnonzero(~is_calf_feed)
+        self.teaching_rows = np.flatnonzero(fd_name.isin(get_teaching_feeds()).to_numpy())
+
+    def column_positions(self, groups: list | None) -> list:
+        '''Positions of the columns in `groups` (in order, without repeats), or all columns if None'''
+        if groups is None:
+            return list(range(self.n_columns))
+
+        positions = []
+        seen = set()
+        for group in groups:
+            for i in self.group_positions[group]:
+                if i not in seen:
+                    seen.add(i)
+                    positions.append(i)
+        return positions
+
+    def view(self, df: pd.DataFrame, groups: list | None = None, hide_calf_feeds: bool = False) -> pd.DataFrame:
+        '''
+        Selects the columns in `groups` from `df` (the indexed library, or a
+        renamed version of it), optionally without calf feeds.
+        '''
+        rows = self.non_calf_rows if hide_calf_feeds else slice(None)
+        return df.iloc[rows, self.column_positions(groups)]
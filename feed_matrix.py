@@ -0,0 +1,67 @@
+# feed_matrix.py
+'''
+Fast diet composition from the feed library, without running the model.
+
+Diet concentrations such as Dt_CP are DM-weighted averages of the feed library
+columns (e.g. Fd_CP), so they can be calculated as a matrix-vector product of
+the kg DM of each feed and a pre-computed matrix of feed nutrients. This is used
+to update the Diet page immediately when kg are changed, while the full model
+run happens afterwards.
+'''
+import numpy as np
+import pandas as pd
+
+# Diet components that are linear in the feed library, i.e. Dt_<x> is the
+# DM-weighted average of Fd_<x>. Protein fractions (RDP/RUP) depend on passage
+# rates calculated by the model, so are not included.
+preview_nutrients = ['CP', 'NDF', 'ADF', 'St', 'CFat', 'Ash']
+
+
+class FeedNutrientMatrix:
+    '''
+    A matrix of feed nutrient concentrations (% DM), with a row for each feed
+    in the library (indexed by Fd_Name) and a column for each nutrient.
+    '''
+    def __init__(self, feed_library: pd.DataFrame, nutrients: list = preview_nutrients):
+        self.nutrients = [n for n in nutrients if f'Fd_{n}' in feed_library.columns]
+
+        # Where a feed is in the library more than once the first is used
+        feeds = feed_library.drop_duplicates('Fd_Name')
+        self.feed_rows = {name: i for i, name in enumerate(feeds['Fd_Name'])}
+        self.matrix = np.nan_to_num(
+            feeds[[f'Fd_{n}' for n in self.nutrients]].to_numpy(dtype=np.float64)
+            )
+
+    def diet_composition(self, user_diet: pd.DataFrame) -> 'DietComposition':
+        '''
+        Calculates the composition of a user_diet (Feedstuff, kg_user).
+        Feeds that aren't in the library (e.g. not selected yet) are ignored.
+        '''
+        rows = user_diet['Feedstuff'].map(self.feed_rows)
+        in_library = rows.notna().to_numpy()
+        kg = user_diet['kg_user'].to_numpy(dtype=np.float64)[in_library]
+
+        # kg of each nutrient in the diet
+        nutrient_kg = kg @ self.matrix[rows[in_library].astype(int).to_numpy()] / 100
+        return DietComposition(dict(zip(self.nutrients, nutrient_kg)), kg.sum())
+
+
+class DietComposition:
+    '''
+    Diet composition calculated by FeedNutrientMatrix. Has the same get_value()
+    interface as nd.ModelOutput for the Dt_ variables it can calculate, and
+    returns None for everything else.
+    '''
+    def __init__(self, nutrient_kg: dict, total_kg: float):
+        self.nutrient_kg = nutrient_kg
+        self.total_kg = total_kg
+
+    def get_value(self, name: str) -> float | None:
+        if not name.startswith('Dt_') or self.total_kg <= 0:
+            return None
+        nutrient = name[3:]
+        if nutrient.endswith('In') and nutrient[:-2] in self.nutrient_kg:
+            return self.nutrient_kg[nutrient[:-2]]
+        if nutrient in self.nutrient_kg:
+            return self.nutrient_kg[nutrient] / self.total_kg * 100
+        return None
@@ -0,0 +1,81 @@
+# feed_search.py
+'''
+Searching feed names for the feed dropdowns on the Diet tab.
+
+Rather than sending every feed name to each dropdown, the dropdowns ask the
+server for the feeds that match what has been typed (see loadFeedSearch() in
+www/custom.js). Matches are found with an n-gram index of each feed's name and
+category (see search_index.py), built once per feed library.
+'''
+import re
+
+import pandas as pd
+
+from search_index import NgramIndex
+
+# Most feeds returned by one search
+max_search_results = 100
+
+
+class FeedSearchIndex:
+    '''
+    Index of the unique feed names in a feed library (with 'Fd_Name' and
+    'Fd_Category' columns), in library order.
+    '''
+    def __init__(self, feed_library: pd.DataFrame):
+        feeds = feed_library.drop_duplicates('Fd_Name')
+        self.names = feeds['Fd_Name'].astype(str).to_list()
+        self.categories = feeds['Fd_Category'].fillna('').astype(str).to_list()
+        self.positions = {name: i for i, name in enumerate(self.names)}
+
+        self._names_lower = [name.lower() for name in self.names]
+        self._categories_lower = [category.lower() for category in self.categories]
+        self._name_words = [tuple(re.findall(r'\w+', name)) for name in self._names_lower]
+        self._index = NgramIndex(zip(self._names_lower, self._categories_lower))
+
+    def _rank(self, i: int, query: str, keywords: list) -> int:
+        '''
+        0: the name starts with the query, 1: each keyword starts a word in the
+        name, 2: each keyword is in the name, 3: otherwise (matched by category)
+        '''
+        name = self._names_lower[i]
+        if name.startswith(query):
+            return 0
+        words = self._name_words[i]
+        if all(any(word.startswith(kw) for word in words) for kw in keywords):
+            return 1
+        if all(kw in name for kw in keywords):
+            return 2
+        return 3
+
+    def search(self, query: str, limit: int = max_search_results, match_all: bool = True) -> list:
+        '''
+        Returns the names of up to `limit` feeds where the name or category
+        contains each (or with `match_all=False`, any) of the space-separated
+        words in `query`, ignoring case. The best matches are first, then in
+        library order. An empty query returns the first feeds in the library.
+        '''
+        query = ' '.join(query.lower().split())
+        if not query:
+            return self.names[:limit]
+
+        keywords = query.split(' ')
+        matched = None
+        for kw in keywords:
+            ids = self._index.matches(kw)
+            if matched is None:
+                matched = ids
+            else:
+                matched = matched & ids if match_all else matched | ids
+
+        ranked = sorted(matched, key=lambda i: (self._rank(i, query, keywords), i))
+        return [self.names[i] for i in ranked[:limit]]
+
+    def choices(self, names: list) -> list:
+        '''Dropdown options for `names`, grouped by feed category'''
+        return [
+            {'value': name, 'label': name, 'optgroup': self.categories[self.positions[name]]}
+            if name in self.positions
+            else {'value': name, 'label': name}
+            for name in names
+            ]
@@ -1,10 +1,21 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 import pandas as pd
 import datetime
 
 import nasem_dairy as nd
 
-def generate_summary_report(
+# Each <table> in a report is given these classes
+_table_tag = re.compile(r'<table\b[^>]*>')
+_table_tag_with_classes = '<table class="table table-striped custom-table">'
+
+def table_to_html(df: pd.DataFrame, **kwargs) -> str:
+    '''Converts a DataFrame to an HTML table for a report, `kwargs` are passed to to_html()'''
+    return _table_tag.sub(_table_tag_with_classes, df.to_html(**kwargs))
+
+
+def summary_report_tables(
     # Model Evaluation
     df_milk: pd.DataFrame,
     df_allowable_milk: pd.DataFrame,
@@ -18,37 +29,38 @@ def generate_summary_report(
     df_energy_teaching: pd.DataFrame,
     df_animal_input_comparison: pd.DataFrame,
     dict_equation_selections: dict,
-    df_snapshot: pd.DataFrame
-    ):
+    df_snapshot: pd.DataFrame,
+    table_html: Callable[[pd.DataFrame], str] = table_to_html
+    ) -> dict:
 
     '''
-    Generates a markdown report and converts to HTML.
-
-    The HTML is returned as a string, ready to be written to a file or displayed.
+    Converts each table in the summary report to HTML with `table_html`. These 
+    only change when the model is run, so they can be kept for repeat 
+    downloads (see summary_report_html()).
     '''
-    # Get the current UTC date and time
-    current_datetime = datetime.datetime.now(datetime.timezone.utc)
-    current_datetime_str = current_datetime.strftime('%Y-%m-%d %H:%M:%S UTC')
-
     # Convert the dictionary of equation selections to a DataFrame
     df_equation_selections = pd.DataFrame(dict_equation_selections.items(), columns=['Variable Name', 'Value'])
 
-    # Convert each DataFrame to HTML
-    html_milk = df_milk.to_html()
-    html_allowable_milk = df_allowable_milk.to_html()
-    html_ME = df_ME.to_html()
-    html_MP = df_MP.to_html()
-    html_diet_summary = df_diet_summary.to_html()
-    html_NEL = df_NEL.to_html()
-    html_DCAD = df_DCAD.to_html()
-    html_ration_ingredients = df_ration_ingredients.to_html()
-    html_energy_teaching = df_energy_teaching.to_html()
-    html_user_input_compare = df_animal_input_comparison.to_html()
-    html_equation_selections = df_equation_selections.to_html()
-    html_snapshot = df_snapshot.to_html()
-
-    # HTML structure with client-side timezone detection and filler intro
-    html = f"""
+    frames = {
+        'milk': df_milk,
+        'allowable_milk': df_allowable_milk,
+        'ME': df_ME,
+        'MP': df_MP,
+        'diet_summary': df_diet_summary,
+        'NEL': df_NEL,
+        'DCAD': df_DCAD,
+        'ration_ingredients': df_ration_ingredients,
+        'energy_teaching': df_energy_teaching,
+        'user_input_compare': df_animal_input_comparison,
+        'equation_selections': df_equation_selections,
+        'snapshot': df_snapshot
+        }
+    return {name: table_html(df) for name, df in frames.items()}
+
+
+# The summary report, with the HTML of each table from summary_report_tables()
+# in place of {tables['name']}
+_summary_report_template = """
         <html>
         <head>
             <title>My Report</title>
@@ -91,27 +103,27 @@ def generate_summary_report(
 
                 <h3>Model Snapshot</h3>
                 <div class="table-responsive">
-                    {html_snapshot}
+                    {tables['snapshot']}
                 </div>
 
                 <h3>Milk DataFrame</h3>
                 <div class="table-responsive">
-                    {html_milk}
+                    {tables['milk']}
                 </div>
 
                 <h3>Allowable Milk DataFrame</h3>
                 <div class="table-responsive">
-                    {html_allowable_milk}
+                    {tables['allowable_milk']}
                 </div>
 
                 <h3>ME DataFrame</h3>
                 <div class="table-responsive">
-                    {html_ME}
+                    {tables['ME']}
                 </div>
 
                 <h3>MP DataFrame</h3>
                 <div class="table-responsive">
-                    {html_MP}
+                    {tables['MP']}
                 </div>
                 <br><br>
 
@@ -119,43 +131,43 @@ def generate_summary_report(
 
                 <h3>Diet Summary DataFrame</h3>
                 <div class="table-responsive">
-                    {html_diet_summary}
+                    {tables['diet_summary']}
                 </div>
                 <br>
 
                 <h3>NEL DataFrame</h3>
                 <div class="table-responsive">
-                    {html_NEL}
+                    {tables['NEL']}
                 </div>
                 <br>
 
                 <h3>DCAD DataFrame</h3>
                 <div class="table-responsive">
-                    {html_DCAD}
+                    {tables['DCAD']}
                 </div>
                 <br>
 
                 <h3>Ration Ingredients DataFrame</h3>
                 <div class="table-responsive">
-                    {html_ration_ingredients}
+                    {tables['ration_ingredients']}
                 </div>
                 <br><br>
 
                 <h2 class="bg-info text-white">Energy Teaching</h2>
                 <div class="table-responsive">
-                    {html_energy_teaching}
+                    {tables['energy_teaching']}
                 </div>
                 <br><br>
 
                 <h2 class="bg-info text-white">User Inputs</h2>
                 <div class="table-responsive">
-                    {html_user_input_compare}
+                    {tables['user_input_compare']}
                 </div>
                 <br>
 
                 <h3>Equation Selections</h3>
                 <div class="table-responsive">
-                    {html_equation_selections}
+                    {tables['equation_selections']}
                 </div>
             </div>
 
@@ -166,34 +178,167 @@ def generate_summary_report(
         </body>
         </html>
     """
+# Alternating text and table names
+_summary_report_parts = re.split(r"\{tables\['(\w+)'\]\}", _summary_report_template)
 
-    # Define the regex pattern for finding <table> elements
-    pattern = r'<table\b[^>]*>'
 
-    # Replace <table> elements with custom classes
-    html_with_classes = re.sub(pattern, '<table class="table table-striped custom-table">', html)
+def iter_summary_report(tables: dict):
+    '''
+    Generates the summary report from the HTML `tables` made by 
+    summary_report_tables(), as chunks of HTML in order (e.g. for a 
+    streaming download).
+    '''
+    # Get the current UTC date and time
+    current_datetime = datetime.datetime.now(datetime.timezone.utc)
+    current_datetime_str = current_datetime.strftime('%Y-%m-%d %H:%M:%S UTC')
+
+    for i, part in enumerate(_summary_report_parts):
+        if i % 2 == 0:
+            yield part.format(current_datetime_str=current_datetime_str)
+        else:
+            yield tables[part]
 
-    return html_with_classes
 
+def summary_report_html(tables: dict) -> str:
+    '''
+    Generates the summary report from the HTML `tables` made by 
+    summary_report_tables().
+
+    The HTML is returned as a string, ready to be written to a file or displayed.
+    '''
+    return ''.join(iter_summary_report(tables))
 
 
+def generate_summary_report(
+    # Model Evaluation
+    df_milk: pd.DataFrame,
+    df_allowable_milk: pd.DataFrame,
+    df_ME: pd.DataFrame,
+    df_MP: pd.DataFrame,
+    # Diet Analysis
+    df_diet_summary: pd.DataFrame,
+    df_NEL: pd.DataFrame,
+    df_DCAD: pd.DataFrame,
+    df_ration_ingredients: pd.DataFrame,
+    df_energy_teaching: pd.DataFrame,
+    df_animal_input_comparison: pd.DataFrame,
+    dict_equation_selections: dict,
+    df_snapshot: pd.DataFrame
+    ):
 
+    '''
+    Generates a markdown report and converts to HTML.
 
-def generate_full_report(ModelOutput: nd.ModelOutput, table_names):
+    The HTML is returned as a string, ready to be written to a file or displayed.
     '''
-    Generates a full report by fetching each table, converting to HTML, and compiling them into a single HTML document.
+    return summary_report_html(summary_report_tables(
+        df_milk, df_allowable_milk, df_ME, df_MP, df_diet_summary, df_NEL, df_DCAD,
+        df_ration_ingredients, df_energy_teaching, df_animal_input_comparison,
+        dict_equation_selections, df_snapshot
+        ))
+
+
+# Tables in the full report, as in the NASEM Dairy-8 software
+full_report_table_names = [
+    "table1_1", "table1_2", "table1_3b", "table2_1", "table2_2", 
+    "table3_1", "table4_1", "table4_2", "table4_3", "table5_1", 
+    "table6_1", "table6_2", "table6_3", "table6_4", "table6_5", 
+    "table7_1", "table7_2", "table7_3", "table8_1", "table8_2"
+    ]
+
+
+def sentence_case(text):
+    """Converts a string like 'table1_1' to 'Table 1.1'."""
+    # Replace underscores with spaces
+    text_with_spaces = text.replace("_", " ")
+    
+    # Find numeric patterns and replace them with a dot separator (1_1 -> 1.1)
+    text_with_dots = re.sub(r'(\d+) (\d+)', r'\1.\2', text_with_spaces)
+    
+    # Capitalize the first word and return the formatted string
+    return text_with_dots.capitalize()
+
+
+def full_report_section(ModelOutput: nd.ModelOutput, table_name: str, i: int) -> str:
+    '''
+    The HTML for one table of the full report, as the `i`th section. If the 
+    table can't be made, the section is an error message.
+    '''
+    try:
+        # Fetch the DataFrame using the get_report method from the ModelOutput object
+        html_table = table_to_html(ModelOutput.get_report(table_name))
+    except Exception as e:
+        # If an error occurs (e.g., table not found), display an error message
+        return f"""
+            <div class="alert alert-danger" role="alert">
+                Error loading table {table_name}: {str(e)}
+            </div>
+            """
+
+    formatted_table_name = sentence_case(table_name)
+
+    return f"""
+            <div class="card">
+                <div class="card-header" id="heading{i}">
+                    <h2 class="mb-0">
+                        <button class="btn btn-link" type="button" data-toggle="collapse" 
+                                data-target="#collapse{i}" aria-expanded="true" aria-controls="collapse{i}">
+                            <span>&#x25BC;</span> {table_name}
+                        </button>
+                    </h2>
+                </div>
+                <div id="collapse{i}" class="collapse" aria-labelledby="heading{i}" data-parent="#report-accordion">
+                    <div class="card-body">
+                        <h3>{formatted_table_name}</h3>
+                        <div class="table-responsive">
+                            {html_table}
+                        </div>
+                    </div>
+                </div>
+            </div>
+            """
+
+
+def iter_full_report_sections(ModelOutput: nd.ModelOutput, table_names: list, max_workers: int = 1):
+    '''
+    Generates the HTML section for each of `table_names` in order (see 
+    full_report_section()). Sections are made as they are needed, or with 
+    `max_workers` threads. They aren't kept after the download, so only the 
+    model output itself takes up memory in the result cache.
+    '''
+    keys = list(enumerate(table_names, start=1))
+
+    executor = None
+    if max_workers > 1 and len(keys) > 1:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        made = executor.map(lambda key: full_report_section(ModelOutput, key[1], key[0]), keys)
+    else:
+        made = (full_report_section(ModelOutput, table_name, i) for i, table_name in keys)
+
+    try:
+        yield from made
+    finally:
+        if executor is not None:
+            # e.g. the download was cancelled
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_full_report(ModelOutput: nd.ModelOutput, table_names, max_workers: int = 1):
+    '''
+    Generates the full report as chunks of HTML in order: the header, each 
+    table (as it is made) and the footer. Used for streaming downloads, so 
+    the whole report is never held as one string.
     
     :param ModelOutput: The model output object from nasem_dairy that provides the get_report method.
     :param table_names: List of table names to generate the report for.
-    :return: The compiled HTML string.
+    :param max_workers: Threads used to make the tables, see iter_full_report_sections().
     '''
     
     # Get the UTC time for the report generation
     current_datetime = datetime.datetime.now(datetime.timezone.utc)
     current_datetime_str = current_datetime.strftime('%Y-%m-%d %H:%M:%S UTC')
 
-    # Start HTML compilation
-    html = f"""
+    yield f"""
     <html>
     <head>
         <title>Full NASEM Report</title>
@@ -249,59 +394,9 @@ def generate_full_report(ModelOutput: nd.ModelOutput, table_names):
             <div class="accordion" id="report-accordion">
     """
 
-    def sentence_case(text):
-        """Converts a string like 'table1_1' to 'Table 1.1'."""
-        # Replace underscores with spaces
-        text_with_spaces = text.replace("_", " ")
-        
-        # Find numeric patterns and replace them with a dot separator (1_1 -> 1.1)
-        text_with_dots = re.sub(r'(\d+) (\d+)', r'\1.\2', text_with_spaces)
-        
-        # Capitalize the first word and return the formatted string
-        return text_with_dots.capitalize()
-
-
-    # Loop through the table names and generate HTML for each one
-    for i, table_name in enumerate(table_names, start=1):
-        try:
-            # Fetch the DataFrame using the get_report method from the ModelOutput object
-            df = ModelOutput.get_report(table_name)
-            # Convert DataFrame to HTML
-            html_table = df.to_html(classes="table table-striped custom-table")
-            
-            formatted_table_name = sentence_case(table_name)
-
-            # Add this table to the report
-            html += f"""
-            <div class="card">
-                <div class="card-header" id="heading{i}">
-                    <h2 class="mb-0">
-                        <button class="btn btn-link" type="button" data-toggle="collapse" 
-                                data-target="#collapse{i}" aria-expanded="true" aria-controls="collapse{i}">
-                            <span>&#x25BC;</span> {table_name}
-                        </button>
-                    </h2>
-                </div>
-                <div id="collapse{i}" class="collapse" aria-labelledby="heading{i}" data-parent="#report-accordion">
-                    <div class="card-body">
-                        <h3>{formatted_table_name}</h3>
-                        <div class="table-responsive">
-                            {html_table}
-                        </div>
-                    </div>
-                </div>
-            </div>
-            """
-        except Exception as e:
-            # If an error occurs (e.g., table not found), display an error message
-            html += f"""
-            <div class="alert alert-danger" role="alert">
-                Error loading table {table_name}: {str(e)}
-            </div>
-            """
+    yield from iter_full_report_sections(ModelOutput, table_names, max_workers)
 
-    # Close the accordion and HTML document
-    html += """
+    yield """
             </div> <!-- End of accordion -->
         </div> <!-- End of container -->
         <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
@@ -311,10 +406,14 @@ def generate_full_report(ModelOutput: nd.ModelOutput, table_names):
     </html>
     """
 
-    # Define the regex pattern for finding <table> elements
-    pattern = r'<table\b[^>]*>'
-
-    # Replace <table> elements with custom classes
-    html_with_classes = re.sub(pattern, '<table class="table table-striped custom-table">', html)
 
-    return html_with_classes
+def generate_full_report(ModelOutput: nd.ModelOutput, table_names, max_workers: int = 1):
+    '''
+    Generates a full report by fetching each table, converting to HTML, and compiling them into a single HTML document.
+    
+    :param ModelOutput: The model output object from nasem_dairy that provides the get_report method.
+    :param table_names: List of table names to generate the report for.
+    :param max_workers: Threads used to make the tables, see iter_full_report_sections().
+    :return: The compiled HTML string.
+    '''
+    return ''.join(iter_full_report(ModelOutput, table_names, max_workers))
@@ -0,0 +1,411 @@
+# model_runner.py
+'''
+Helpers for executing nd.nasem from the app.
+
+Model runs are cached for the whole process (i.e. shared by every session
+connected to this worker) and keyed by a fingerprint of the model inputs, so
+repeated runs with identical inputs (demo diets, tab switches, restored
+sessions) return immediately.
+
+Runs from the app are executed in a pool of worker processes so that a long
+model run doesn't block the event loop that all sessions share. Shared feed
+libraries (i.e. the default library) aren't sent to the workers with each run;
+each worker memory-maps the same cache file instead (see data_loader.py).
+'''
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cache
+
+import pandas as pd
+import nasem_dairy as nd
+
+from data_loader import read_csv_cached
+
+
+################################################################################
+# Input fingerprints
+################################################################################
+
+def fingerprint_dataframe(df: pd.DataFrame) -> str:
+    '''
+    Returns a stable hash of a DataFrame's values, index, column names and dtypes.
+    Two frames with the same contents always return the same fingerprint.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([str(col) for col in df.columns]).encode())
+    h.update(json.dumps([str(dtype) for dtype in df.dtypes]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def fingerprint_model_inputs(user_diet: pd.DataFrame,
+                             animal_input: dict,
+                             equation_selection: dict,
+                             feed_library_fingerprint: str) -> str:
+    '''
+    Combine everything that nd.nasem() depends on into a single cache key.
+    The feed library is passed as a pre-computed fingerprint because it rarely
+    changes and is expensive to hash compared to the other inputs.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(fingerprint_dataframe(user_diet).encode())
+    h.update(json.dumps(animal_input, sort_keys=True, default=str).encode())
+    h.update(json.dumps(equation_selection, sort_keys=True, default=str).encode())
+    h.update(feed_library_fingerprint.encode())
+    return h.hexdigest()
+
+
+################################################################################
+# Result cache
+################################################################################
+
+class ModelResultCache:
+    '''
+    Thread-safe LRU cache of ModelOutput objects.
+
+    Entries are evicted (least recently used first) when either `max_entries`
+    or `max_bytes` is exceeded. The size of each entry is estimated from its
+    pickled size, which is only calculated when `max_bytes` is set.
+    '''
+    def __init__(self, max_entries: int = 256, max_bytes: int | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[nd.ModelOutput, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> nd.ModelOutput | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, model_output: nd.ModelOutput) -> None:
+        if self.max_entries <= 0:
+            return
+        size = _estimate_size(model_output) if self.max_bytes is not None else 0
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (model_output, size)
+            self._total_bytes += size
+
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self._total_bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+def _estimate_size(model_output: nd.ModelOutput) -> int:
+    try:
+        return len(pickle.dumps(model_output, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        # Unpicklable outputs are still cached, but don't count towards max_bytes
+        return 0
+
+
+def env_int(name: str, default: int | None) -> int | None:
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return int(value)
+
+
+# Shared by all sessions in this process.
+# Tune with NASEM_CACHE_MAX_ENTRIES (0 disables the cache) and
+# NASEM_CACHE_MAX_MB (0 removes the memory limit).
+_max_mb = env_int('NASEM_CACHE_MAX_MB', 256)
+model_cache = ModelResultCache(
+    max_entries=env_int('NASEM_CACHE_MAX_ENTRIES', 256),
+    max_bytes=_max_mb * 1024 * 1024 if _max_mb else None
+)
+
+
+################################################################################
+# Shared feed libraries
+################################################################################
+
+class SharedFeedLibrary:
+    '''
+    Sent to worker processes in place of a feed library that they can load 
+    themselves from its memory-mapped cache file.
+    '''
+    def __init__(self, csv_path: str, sort_by: str | None, fingerprint: str):
+        self.csv_path = csv_path
+        self.sort_by = sort_by
+        self.fingerprint = fingerprint
+
+    def load(self) -> pd.DataFrame:
+        return _load_shared_feed_library(self.csv_path, self.sort_by, self.fingerprint)
+
+
+@cache
+def _load_shared_feed_library(csv_path: str, sort_by: str | None, fingerprint: str) -> pd.DataFrame:
+    # Loaded once per worker process
+    feed_library = read_csv_cached(csv_path, sort_by=sort_by)
+    if fingerprint_dataframe(feed_library) != fingerprint:
+        raise RuntimeError(f"{csv_path} has changed since it was loaded by the app, please restart the app")
+    return feed_library
+
+
+# Keyed by fingerprint, so a library is recognised however it was passed in
+_shared_feed_libraries: dict[str, SharedFeedLibrary] = {}
+
+
+def share_feed_library(feed_library: pd.DataFrame, csv_path: str | os.PathLike, sort_by: str | None = None) -> None:
+    '''
+    Marks a feed library that was loaded with read_csv_cached(csv_path, sort_by)
+    as shared, so that worker processes load it from the memory-mapped cache
+    rather than being sent a copy with every model run.
+    '''
+    fingerprint = fingerprint_dataframe(feed_library)
+    _shared_feed_libraries[fingerprint] = SharedFeedLibrary(str(csv_path), sort_by, fingerprint)
+
+
+################################################################################
+# Model execution
+################################################################################
+
+def execute_nasem(user_diet: pd.DataFrame,
+                   animal_input: dict,
+                   equation_selection: dict,
+                   feed_library: pd.DataFrame | SharedFeedLibrary) -> nd.ModelOutput:
+    '''
+    Runs the model without any caching (e.g. for batches, where each run is 
+    only needed once). This is a module level function so that it can be sent 
+    to worker processes.
+    '''
+    if isinstance(feed_library, SharedFeedLibrary):
+        feed_library = feed_library.load()
+
+    # nd.nasem can modify the animal_input dict, so always pass a copy
+    return nd.nasem(
+        user_diet,
+        animal_input.copy(),
+        equation_selection,
+        feed_library
+        )
+
+
+################################################################################
+# Worker pool
+################################################################################
+
+_executor: ProcessPoolExecutor | ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_model_executor() -> ProcessPoolExecutor | ThreadPoolExecutor:
+    '''
+    Returns the pool used for model runs, creating it on first use.
+
+    The number of workers is set with NASEM_MODEL_WORKERS (defaults to the number
+    of CPUs, up to 4). Setting it to 0 runs the model in a background thread of
+    this process instead, which is useful when debugging.
+    '''
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            max_workers = env_int('NASEM_MODEL_WORKERS', min(4, os.cpu_count() or 1))
+            if max_workers <= 0:
+                _executor = ThreadPoolExecutor(max_workers=1)
+            else:
+                # 'spawn' avoids forking the web server (and its event loop) into workers
+                _executor = ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                    )
+    return _executor
+
+
+class _InflightRun:
+    def __init__(self, run):
+        # The concurrent.futures.Future of the run in the pool, and the asyncio
+        # future that callers await
+        self.run = run
+        self.future = asyncio.wrap_future(run)
+        self.callers = 1
+        self.waiting = 0
+
+
+class SingleFlight:
+    '''
+    Deduplicates identical model runs that are in progress at the same time.
+
+    The first caller for a key starts the run; callers with the same key that
+    arrive before it finishes wait on the same result instead of starting their
+    own. Must be used from the event loop thread (all sessions share one loop).
+    '''
+    def __init__(self):
+        self._inflight: dict[str, _InflightRun] = {}
+        self.runs = 0
+        self.coalesced = 0
+        # Finished runs that had more than one caller, and the most callers of a run
+        self.shared_runs = 0
+        self.max_callers = 1
+
+    async def run(self, key: str, start) -> nd.ModelOutput:
+        '''
+        Await the run for `key`, calling `start()` to submit it to the worker 
+        pool if it isn't already running. `start` must return a 
+        concurrent.futures.Future.
+        '''
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight.run.cancelled():
+            # Removed from the pool's queue, but _on_done() hasn't been called yet
+            inflight = None
+
+        if inflight is None:
+            loop = asyncio.get_running_loop()
+            inflight = _InflightRun(start())
+            # The result is cached when the worker finishes, even if every 
+            # caller has stopped waiting for it
+            inflight.run.add_done_callback(
+                lambda _: loop.call_soon_threadsafe(self._on_done, key, inflight)
+                )
+            self._inflight[key] = inflight
+            self.runs += 1
+        else:
+            if inflight.future.cancelled():
+                # Everyone waiting left after a worker had started the run
+                inflight.future = asyncio.wrap_future(inflight.run)
+            inflight.callers += 1
+            self.coalesced += 1
+
+        future = inflight.future
+        inflight.waiting += 1
+        try:
+            # shield() so one caller being cancelled doesn't cancel the run for the others
+            return await asyncio.shield(future)
+        finally:
+            inflight.waiting -= 1
+            if inflight.waiting == 0 and not future.done():
+                # Nobody is waiting anymore. This only stops the run if a worker 
+                # hasn't picked it up yet
+                future.cancel()
+
+    def _on_done(self, key: str, inflight: _InflightRun):
+        '''Called on the event loop once the run has finished or been cancelled'''
+        if self._inflight.get(key) is inflight:
+            del self._inflight[key]
+        if inflight.callers > 1:
+            self.shared_runs += 1
+            self.max_callers = max(self.max_callers, inflight.callers)
+        if inflight.run.cancelled() or inflight.run.exception() is not None:
+            return
+        model_cache.put(key, inflight.run.result())
+
+    def stats(self) -> dict:
+        return {
+            'in_progress': len(self._inflight),
+            'runs': self.runs,
+            'coalesced': self.coalesced,
+            'shared_runs': self.shared_runs,
+            'max_callers': self.max_callers,
+            'callers_per_run': round((self.runs + self.coalesced) / self.runs, 3) if self.runs else 0.0,
+        }
+
+
+# Shared by all sessions in this process
+model_single_flight = SingleFlight()
+
+
+async def run_nasem_async(user_diet: pd.DataFrame,
+                          animal_input: dict,
+                          equation_selection: dict,
+                          feed_library: pd.DataFrame,
+                          feed_library_fingerprint: str | None = None) -> nd.ModelOutput:
+    '''
+    Async version of run_nasem(). Cache misses are executed in the worker pool,
+    so the event loop stays free to serve other sessions while the model runs.
+    Concurrent calls with identical inputs (e.g. a class loading the same demo 
+    diet) share a single run.
+
+    If every caller is cancelled before a worker picks up the run, the run is
+    removed from the pool's queue. A run that has already started can't be
+    stopped, so it finishes and its result is added to the cache.
+    '''
+    if feed_library_fingerprint is None:
+        feed_library_fingerprint = fingerprint_dataframe(feed_library)
+
+    key = fingerprint_model_inputs(
+        user_diet, animal_input, equation_selection, feed_library_fingerprint
+        )
+
+    model_output = model_cache.get(key)
+    if model_output is None:
+        # Custom libraries are sent to the worker, shared libraries are loaded by it
+        feed_library = _shared_feed_libraries.get(feed_library_fingerprint, feed_library)
+        model_output = await model_single_flight.run(
+            key,
+            lambda: get_model_executor().submit(
+                execute_nasem, user_diet, animal_input, equation_selection, feed_library
+                )
+            )
+
+    return model_output
+
+
+class ModelRunTracker:
+    '''
+    Tracks the generation (a counter) of the newest model run requested by a 
+    session. A run whose generation is no longer current has been superseded 
+    by newer inputs and its result should be discarded. The inputs of the 
+    newest run (see fingerprint_model_inputs()) are kept so that they aren't 
+    run twice in a row. The newest generation that has finished (or was
+    cancelled) tells whether a run is still pending.
+    '''
+    def __init__(self):
+        self.generation = 0
+        self.finished = 0
+        self.inputs_key = None
+
+    def next_generation(self, inputs_key: str | None = None) -> int:
+        self.generation += 1
+        self.inputs_key = inputs_key
+        return self.generation
+
+    def is_current(self, generation: int) -> bool:
+        return generation == self.generation
+
+    def finish(self, generation: int) -> None:
+        self.finished = max(self.finished, generation)
+
+    def is_pending(self) -> bool:
+        return self.finished < self.generation
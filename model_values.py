@@ -0,0 +1,198 @@
+# model_values.py
+'''
+The numeric values of a model run, extracted once into a single table.
+
+The Outputs tab, the Diet snapshot and the reports each show model variables
+with their descriptions. ModelOutput.get_value() searches the nested model
+output for each variable, and each table was then merged with the variable
+descriptions. Instead, the model output is flattened once per run into a
+DataFrame indexed by variable name, which every table selects its rows from.
+'''
+import re
+from functools import cached_property, lru_cache
+
+import numpy as np
+import pandas as pd
+import nasem_dairy as nd
+
+from utils import get_var_descriptions, report_unknown_vars
+from search_index import NgramIndex
+
+# Values in tables are rounded to this many significant figures (as in get_clean_vars())
+sig_figs = 4
+
+# Searches with any of these are regular expressions
+_regex_chars = re.compile(r'[\\^$.|?*+()\[\]{}]')
+
+
+def _flatten(model_output: nd.ModelOutput) -> dict:
+    '''
+    Returns {name: (value, category, group)} for every named value in
+    `model_output`, including DataFrame columns. Where a name is used more than
+    once, the value is the one ModelOutput.get_value() returns: the first
+    found in each category's dictionary before searching the dictionaries
+    (and DataFrames) it contains, in order.
+    '''
+    found = {}
+
+    def visit(dictionary: dict, category: str, group: str | None):
+        for key, value in dictionary.items():
+            if key not in found and value is not None:
+                found[key] = (value, category, group or key)
+        for key, value in dictionary.items():
+            if isinstance(value, dict):
+                visit(value, category, group or key)
+            elif isinstance(value, pd.DataFrame):
+                for column in value.columns:
+                    if column not in found:
+                        found[column] = (value[column], category, group or key)
+
+    for category in model_output.categories:
+        visit(getattr(model_output, category), category, None)
+    return found
+
+
+class VariableSearchIndex:
+    '''
+    Search of model variable names and their descriptions, for the search on
+    the Outputs tab.
+    '''
+    def __init__(self, names: list, descriptions: pd.Series):
+        self.names = list(names)
+        self._names_lower = [name.lower() for name in self.names]
+        self._descriptions_lower = descriptions.reindex(self.names).fillna('').str.lower().to_list()
+        self._index = NgramIndex(zip(self._names_lower, self._descriptions_lower))
+
+    def _rank(self, i: int, query: str, keywords: list) -> int:
+        '''
+        0: the name is the query, 1: the name starts with the query, 2: each
+        keyword is in the name, 3: otherwise (matched by description)
+        '''
+        name = self._names_lower[i]
+        if name == query:
+            return 0
+        if name.startswith(query):
+            return 1
+        if all(kw in name for kw in keywords):
+            return 2
+        return 3
+
+    def search(self, query: str) -> list:
+        '''
+        Names of the variables where the name or description contains each of
+        the space-separated words in `query`, ignoring case. The best matches
+        are first, then in model output order.
+        '''
+        keywords = query.lower().split()
+        if not keywords:
+            return []
+        query = ' '.join(keywords)
+
+        matched = self._index.matches(keywords[0])
+        for kw in keywords[1:]:
+            matched &= self._index.matches(kw)
+        ranked = sorted(matched, key=lambda i: (self._rank(i, query, keywords), i))
+        return [self.names[i] for i in ranked]
+
+
+# The variables in the model output are the same for most runs, so their index
+# is kept for the next run
+@lru_cache(maxsize=4)
+def _variable_search_index(names: tuple) -> VariableSearchIndex:
+    return VariableSearchIndex(names, get_var_descriptions())
+
+
+def round_sig_figs(values: np.ndarray, digits: int = sig_figs) -> np.ndarray:
+    '''
+    Rounds each of `values` to `digits` significant figures. Gives the same
+    result as float(f"{value:.{digits}g}") for each value.
+    '''
+    values = np.asarray(values, dtype=float)
+    nonzero = np.isfinite(values) & (values != 0)
+    magnitude = np.floor(np.log10(np.abs(values, where=nonzero, out=np.ones_like(values))))
+    decimals = digits - 1 - magnitude
+    # Powers of ten above 1e22 aren't exact as floats, so scaling by them 
+    # could change the last digit (e.g. 1e-20). These are rounded as text below
+    extreme = np.abs(decimals) > 22
+    decimals[extreme] = 0
+
+    # Scaled so that the digits to keep are before the decimal point
+    scale = 10.0 ** np.abs(decimals)
+    finite = np.where(nonzero, values, 0.0)
+    scaled = np.where(decimals >= 0, finite * scale, finite / scale)
+    rounded = np.round(scaled)
+    rounded = np.where(decimals >= 0, rounded / scale, rounded * scale)
+    rounded = np.where(nonzero, rounded, values)
+
+    # Where the scaled value is exactly half way, the value may have been
+    # rounded the wrong way by scaling, so these are rounded as text
+    ties = np.abs(scaled - np.trunc(scaled)) == 0.5
+    for i in np.flatnonzero(nonzero & (ties | extreme)):
+        rounded[i] = float(f"{values[i]:.{digits}g}")
+    return rounded
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float, np.integer, np.floating))
+
+
+class ModelValues:
+    '''
+    The numeric values of a ModelOutput. `table` is indexed by 'Model Variable'
+    with the columns 'Value' (rounded to `sig_figs`), 'Description', 'Category'
+    (e.g. 'Production') and 'Group' (e.g. 'milk').
+
+    Has the same get_value() interface as nd.ModelOutput for numeric values,
+    so it can be used with display_diet_values().
+    '''
+    def __init__(self, model_output: nd.ModelOutput, descriptions: pd.Series | None = None):
+        if descriptions is None:
+            descriptions = get_var_descriptions()
+
+        flat = {name: entry for name, entry in _flatten(model_output).items() if _is_number(entry[0])}
+        values = np.fromiter((value for value, _, _ in flat.values()), dtype=float, count=len(flat))
+        self._values = dict(zip(flat, values.tolist()))
+
+        index = pd.Index(list(flat), name='Model Variable')
+        self.table = pd.DataFrame({
+            'Value': round_sig_figs(values),
+            'Description': descriptions.reindex(index).to_numpy(),
+            'Category': [category for _, category, _ in flat.values()],
+            'Group': [group for _, _, group in flat.values()],
+            }, index=index)
+
+    def get_value(self, name: str) -> float | None:
+        return self._values.get(name)
+
+    def get_vars_as_df(self, vars_return: list) -> pd.DataFrame:
+        '''
+        The same table as utils.get_vars_as_df(): 'Model Variable', 'Value' and
+        'Description' for each of `vars_return`, in order.
+        '''
+        # Each variable is shown once
+        vars_return = list(dict.fromkeys(vars_return))
+        report_unknown_vars([var for var in vars_return if var not in self.table.index])
+
+        return self.table.reindex(vars_return, columns=['Value', 'Description']).reset_index()
+
+    @cached_property
+    def search_index(self) -> VariableSearchIndex:
+        return _variable_search_index(tuple(self.table.index))
+
+    def search(self, search_string: str) -> pd.DataFrame:
+        '''
+        Values where the name or description contains each word of
+        `search_string`, ignoring case, with the best matches first (see
+        VariableSearchIndex). A regular expression (e.g. '^Mlk') is matched
+        against the names instead.
+        '''
+        if _regex_chars.search(search_string):
+            try:
+                pattern = re.compile(search_string, re.IGNORECASE)
+            except re.error:
+                pass
+            else:
+                matches = [name for name in self.table.index if pattern.search(name)]
+                return self.table.loc[matches].reset_index(names='Name')
+
+        return self.table.loc[self.search_index.search(search_string)].reset_index(names='Name')
@@ -1,54 +1,77 @@
 # module_diet.py
 
+import itertools
+
 from shiny import Inputs, Outputs, Session, module, render, ui, reactive, req
 import pandas as pd
 from faicons import icon_svg
 import htmltools
 import nasem_dairy as nd
+from starlette.requests import Request
+from starlette.responses import JSONResponse
 
 from utils import (
-    get_unique_feed_list,
     display_diet_values, 
     calculate_DMI_prediction, 
     validate_equation_selections, 
     prepare_df_render,
-    get_vars_as_df,
+    get_model_snapshot,
+    create_user_diet,
     DM_intake_equation_strings) 
-
-
-def insert_new_ingredient(current_iter, feed_choices, feed_selected, kg_selected, perc_selected, session_ns ):
-    newItemDiv = ui.div(
-        {"id": "userfeed_" + current_iter},
+from feed_matrix import FeedNutrientMatrix
+from feed_search import FeedSearchIndex, max_search_results
+
+# The diet is edited in rows of a feed dropdown, kg DM and % DM (see
+# ingredient_row()). These aren't Shiny inputs: www/custom.js sends the changes
+# to each row, by row id, as a list of edits in one input (`diet_edits`), which
+# diet_server() applies to the diet it keeps. The % DM is calculated in the browser.
+#
+# Only the selected feed is sent with each feed dropdown, other feeds are loaded
+# from the server when the dropdown is opened or searched (see loadFeedSearch()
+# in www/custom.js and feed_search_choices() in diet_server).
+# Categories are searched as well as names (see FeedSearchIndex).
+
+# The feed dropdowns are set up by initDietRows() in www/custom.js, but use the
+# selectize.js files that come with Shiny
+selectize_deps = ui.input_selectize('selectize_deps', '', []).get_dependencies()
+
+
+def ingredient_row(row_id: str, feed: str, kg: float):
+    def diet_input(tag):
+        return ui.div({'class': 'form-group shiny-input-container'}, tag)
+
+    return ui.div(
+        {'id': 'userfeed_' + row_id, 'class': 'diet-row', 'data-row-id': row_id},
         ui.row(
-            ui.column(6, ui.input_selectize("item_" + current_iter,
-                                            label="",
-                                            choices=feed_choices,
-                                            selected=feed_selected,
-                                            multiple=False)),
-            ui.column(3, ui.input_numeric('kg_' + current_iter,
-                                          label="",
-                                          min=0,
-                                          max=100,
-                                          step=0.2,
-                                          value=kg_selected)),
-            ui.column(3, ui.input_numeric('perc_' + current_iter,
-                                          label="",
-                                          min=0,
-                                          max=100,
-                                          step=0.2,
-                                          value=perc_selected)),
-        )
+            ui.column(6, diet_input(ui.tags.select(
+                ui.tags.option(feed, value=feed, selected=True),
+                class_='diet-feed',
+                data_shiny_no_bind_input=True))),
+            ui.column(3, diet_input(ui.tags.input(
+                type='number', class_='form-control diet-kg',
+                min=0, max=100, step=0.2, value=kg,
+                data_shiny_no_bind_input=True))),
+            ui.column(2, diet_input(ui.tags.input(
+                type='number', class_='form-control diet-perc',
+                value=0, disabled=True,
+                data_shiny_no_bind_input=True))),
+            ui.column(1, ui.tags.button(
+                icon_svg('xmark'),
+                type='button', class_='btn btn-link diet-remove', title='Remove feed')),
+        ),
     )
-    ui.insert_ui(newItemDiv,
-                #  selector=f"#{session_ns}-item_input",
-                 selector=f"div#userfeed_1",
+
+
+def insert_new_ingredients(rows: list):
+    '''Inserts the rows from ingredient_row() at the end of the diet, in one UI insertion'''
+    ui.insert_ui(ui.TagList(*rows, ui.tags.script('initDietRows();'), *selectize_deps),
+                 selector="div#diet_rows",
                  where="beforeEnd",
-                 immediate=True) # this allows js to access ui and disable perc in correct order
+                 immediate=True)
 
 
-def remove_ingredient(current_iter):
-    print(f'removing UI: userfeed_{current_iter}')
-    ui.remove_ui(selector="div#userfeed_" + str(current_iter))
+def remove_all_ingredients():
+    ui.remove_ui(selector="div#diet_rows > div.diet-row", multiple=True)
 
 @module.ui
 def diet_ui():
@@ -121,27 +144,13 @@ def diet_ui():
                                                                 class_='btn-info')),
                         ),
                         ui.br(),
-                        ui.div(
-                            {"id" : "userfeed_1" },
-                            ui.row(
-                                ui.column(6, ui.input_selectize("item_1" ,
-                                                                "Choose feeds to use in ration:",
-                                                                choices = {},
-                                                                multiple = False)),
-                                ui.column(3, ui.input_numeric('kg_1', 
-                                            label="Enter kg DM:", 
-                                            min=0, 
-                                            max=100, 
-                                            step = 0.2,
-                                            value=0)),
-                                ui.column(3, ui.input_numeric('perc_1',
-                                            label = '% DM:',
-                                            min = 0, 
-                                            max = 100,
-                                            step = 1, 
-                                            value = 0))             
-                            )
+                        ui.row(
+                            ui.column(6, ui.tags.label("Choose feeds to use in ration:")),
+                            ui.column(3, ui.tags.label("Enter kg DM:")),
+                            ui.column(2, ui.tags.label("% DM:")),
                         ),
+                        # Rows are added by diet_server(), see ingredient_row()
+                        ui.div({"id": "diet_rows", "data-input-id": module.resolve_id("diet_edits")}),
                         ui.layout_column_wrap(
                             ui.input_action_button("add_button", "Add another feed", class_='btn-success'),
                             ui.input_action_button('btn_load_user_selected_feeds', 'Add feeds from sidebar', class_='btn-warning'),
@@ -180,124 +189,139 @@ def diet_ui():
 @module.server
 def diet_server(input: Inputs, output: Outputs, session: Session, 
                 NASEM_out, 
+                model_values,
+                model_run_repeated,
                 animal_input_dict, 
                 # equation_selection,
                 animal_input_reactives,
                 user_selected_feed_library,
                 user_selected_feeds,
-                session_upload_ModOut):
+                session_upload_diet):
     
     #######################################################
     # Feed Inputs
     #######################################################
-    #used for 'iterate new ingredient' because variables can't be parsed into these functions
-    # so, the values are assigned to these 2 reactives which are then used by the iterate_new_ingredient function to set up a new feed
-    # originally used by demo diets
-    feed_selected = reactive.Value(None)
-    kg_selected = reactive.Value(0)
-    perc_selected = reactive.Value(0)
-
-    # Initialize reactive values to store user selections
-    user_feeds = reactive.Value(['item_1'])
-    user_kgs = reactive.Value(['kg_1'])
-    user_percs = reactive.Value(['perc_1'])
+    # The diet, as {row id: (feed name, kg DM)} in the order the rows are shown.
+    # Row ids are kept for the session, so edits from the browser always apply
+    # to the right row after others are removed.
+    diet_rows = reactive.Value({})
+    row_ids = itertools.count(1)
 
     @reactive.Calc
-    def unique_fd_list():
-        return get_unique_feed_list(user_selected_feed_library())
-    
-    
-    @reactive.effect
-    def _():
+    def feed_search_index():
+        return FeedSearchIndex(user_selected_feed_library())
+
+    def feed_search_choices(request: Request) -> JSONResponse:
+        '''
+        Returns the feeds matching a search in a feed dropdown. The query
+        parameters are sent by loadFeedSearch() in www/custom.js.
+        '''
+        params = request.query_params
         with reactive.isolate():
-            print('update item_1 - initial line 212')
-            ui.update_selectize('item_1', choices=unique_fd_list())
+            index = feed_search_index()
+        try:
+            limit = min(int(params.get('maxop', max_search_results)), max_search_results)
+        except ValueError:
+            limit = max_search_results
 
+        names = index.search(params.get('query', ''),
+                             limit=limit,
+                             match_all=params.get('conju', 'and') != 'or')
+        return JSONResponse(index.choices(names))
 
+    feed_search_url = session.dynamic_route('feed_search', feed_search_choices)
 
-    @reactive.Calc
-    def iterate_new_ingredient():
+    def first_feed() -> str:
+        '''The feed selected in new rows'''
+        return feed_search_index().names[0]
+
+    def new_rows(feeds: list) -> dict:
         '''
-        This is executed by the reactive event below, and keeps track of new UI 
-        created so that the feed name and kg can be used meaningfully in app.
+        Inserts a row for each (feed name, kg DM) in `feeds`, in one UI insertion.
+        Returns the new rows by row id, to be added to diet_rows.
         '''
-        reset_flag.set(False)
-        current_iter =  str(len(user_feeds()) + 1)
-
-        # copy, append and re-set items and percentages, to keep track of inputs
-        xout = user_feeds().copy()
-        xout.append('item_' + current_iter)
-        user_feeds.set(xout)
-
-        kgout = user_kgs().copy()
-        kgout.append('kg_' + current_iter)
-        user_kgs.set(kgout)
-
-        pout = user_percs().copy()
-        pout.append('perc_' + current_iter)
-        user_percs.set(pout)
-
-        insert_new_ingredient(current_iter = current_iter, 
-                              feed_choices = unique_fd_list(), 
-                              feed_selected=feed_selected(), 
-                              kg_selected=kg_selected(),
-                              perc_selected=perc_selected(),
-                              session_ns = session.ns
-                              )
-        return current_iter
+        rows = {str(next(row_ids)): (feed, kg) for feed, kg in feeds}
+        insert_new_ingredients([ingredient_row(row_id, feed, kg) for row_id, (feed, kg) in rows.items()])
+        return rows
+
+    @reactive.effect
+    async def _():
+        with reactive.isolate():
+            await session.send_custom_message('feedSearchUrl', {'url': feed_search_url})
+            diet_rows.set(new_rows([(first_feed(), 0)]))
+
+    @reactive.Effect
+    @reactive.event(input.diet_edits)
+    def _():
+        '''
+        Applies the edits made in the browser, a list of {'row': <row id>, and any of
+        'Feedstuff', 'kg_user' or 'remove'} (see addDietEdit() in www/custom.js).
+        '''
+        rows = diet_rows().copy()
+        for edit in input.diet_edits():
+            row_id = str(edit.get('row'))
+            if row_id not in rows:
+                continue
+            if edit.get('remove'):
+                del rows[row_id]
+                continue
+            feed, kg = rows[row_id]
+            if 'Feedstuff' in edit:
+                feed = str(edit['Feedstuff'])
+            if 'kg_user' in edit:
+                kg = float(edit['kg_user'] or 0)
+            rows[row_id] = (feed, kg)
+        diet_rows.set(rows)
+
+    async def add_feeds(feeds: list):
+        '''
+        Sets the first feed row to the first of `feeds`, a list of (feed name, kg DM),
+        and adds a row after the current rows for each of the others. The rows
+        are inserted together and diet_rows is set once, so the model is run
+        once for the whole diet.
+        '''
+        if len(feeds) == 0:
+            return
+        rows = diet_rows().copy()
+        if len(rows) > 0:
+            first_row_id = next(iter(rows))
+            rows[first_row_id] = feeds[0]
+            feed, kg = feeds[0]
+            await session.send_custom_message('updateDietRow', {
+                'row': first_row_id, 'Feedstuff': feed, 'kg_user': kg
+                })
+            feeds = feeds[1:]
+        if len(feeds) > 0:
+            rows.update(new_rows(feeds))
+            reset_flag.set(False)
+        diet_rows.set(rows)
 
     # Generate a new item input whenever the "Add another item" button is clicked    
     @reactive.Effect
     @reactive.event(input.add_button)
     def _():
-        iterate_new_ingredient()
+        diet_rows.set({**diet_rows(), **new_rows([(first_feed(), 0)])})
+        reset_flag.set(False)
 
     @reactive.Effect
     @reactive.event(input.btn_load_user_selected_feeds)
-    def _():
+    async def _():
         '''used to update feeds based on user selections'''
         feed_list = user_selected_feeds().to_list()
+        await add_feeds([(feed, 0) for feed in feed_list])
 
-        for i, feed in enumerate(feed_list):
-            if i == 0:
-                ui.update_selectize(id = 'item_1', choices = unique_fd_list(), selected = feed)
-                ui.update_numeric(id = 'kg_1', value = 0, min=0)
-                ui.update_numeric(id = 'perc_1', value = 0, min=0)
-            else:
-                feed_selected.set(feed) # type: ignore
-                kg_selected.set(0)
-                perc_selected.set(0)
-                iterate_new_ingredient()
-        
-        # reset to defaults
-        feed_selected.set(None)
-        kg_selected.set(0)
-        perc_selected.set(0)
-
-    # starts as True because first row is never removed. is set to False for iterate new ingredient
+    # True until feeds are added to the diet, and again after it is reset
     reset_flag = reactive.value(True)
 
     @reactive.Effect
     @reactive.event(input.btn_reset_feeds)
     async def _():
         '''
-        Used to reset feeds back to normal by removing an UI created and 
-        resetting reactive variables that store state.
+        Used to reset feeds back to normal by removing all rows and adding an
+        empty one.
         '''
-        # get number of UI elements
-        current_iter =  len(user_feeds())+1
-        
-        # remove UI elements
-        [remove_ingredient(i) for i in range(2,current_iter)]
-
-        # reset reactive values to store user selections
-        user_feeds.set(['item_1'])
-        user_kgs.set(['kg_1'])
-        user_percs.set(['perc_1'])
-
-        # Update initial UI elements:
-        ui.update_selectize(id = 'item_1', choices=unique_fd_list())
-        ui.update_numeric(id = 'kg_1', value = 0, min=0)
+        remove_all_ingredients()
+        diet_rows.set(new_rows([(first_feed(), 0)]))
 
         # add demo button back:
         if input.add_demo_diet() > 0:
@@ -309,26 +333,11 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
 
     @reactive.Calc
     def get_user_diet():
-        # Get items from input by name
-        # returns a dataframe as a reactive
-        # each 'feed' and 'kg' value is stored in these reactives (named 'item_1', etc) 
-        # which means we can iterate through them and store their values in a list when we need them
-        items = [getattr(input, x) for x in user_feeds()]
-        kg = [getattr(input, x) for x in user_kgs()]
-
-        # Safely convert items to strings, handling None types
-        feedstuff = [str(x()) if x() is not None else '' for x in items]
-        # Safely convert kg to floats, handling None types
-        kg_user = [float(x()) if x() is not None else 0.0 for x in kg]
-
-        tmp_user_diet = pd.DataFrame({'Feedstuff': feedstuff, 
-                                      'kg_user': kg_user})
-
-        tmp_user_diet['Feedstuff'] = tmp_user_diet['Feedstuff'].str.strip()
-        tmp_user_diet['Index'] = tmp_user_diet['Feedstuff']
-        tmp_user_diet = tmp_user_diet.set_index('Index')
-
-        return tmp_user_diet
+        # returns a dataframe as a reactive, in the order the rows are shown
+        rows = list(diet_rows().values())
+        feedstuff = [feed for feed, _ in rows]
+        kg_user = [kg for _, kg in rows]
+        return create_user_diet(feedstuff, kg_user)
 
     @reactive.Calc
     def get_diet_total_intake() -> float:
@@ -381,10 +390,8 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
     @reactive.Effect
     @reactive.event(input.add_demo_diet)
     async def _():
-        ui.update_selectize(id='item_1', choices=unique_fd_list(), selected="Corn silage, typical")
-        ui.update_numeric(id='kg_1', value=9, min=0)
-
         demo_dict = {
+            'Corn silage, typical': 9,
             'Wheat straw': 1,
             'Corn grain HM, fine grind': 5,
             'Triticale silage, mid-maturity': 6.4,
@@ -394,15 +401,7 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
             'Urea': 0.15,
         }
 
-        for feed, kg in demo_dict.items():
-            feed_selected.set(feed)
-            kg_selected.set(kg)
-            perc_selected.set(0)
-            iterate_new_ingredient()
-
-        feed_selected.set(None)
-        kg_selected.set(0)
-        perc_selected.set(0)
+        await add_feeds(list(demo_dict.items()))
         
         # disable button to prevent loading multiple times. On reset, this button 
         # is enabled again.
@@ -418,35 +417,7 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
     
     @reactive.Calc
     def df_model_snapshot():
-        '''
-        A 'snapshot' of the model output, which varies between lactating and 
-        dry cows. Other animal classes could be added here, with similar pattern.
-        '''
-        if animal_input_reactives()['An_StatePhys']() == 'Lactating Cow':
-            vars_return = ['Mlk_Prod_comp','MlkFat_Milk_p', 'MlkNP_Milk_p', 
-                           'Mlk_Prod_MPalow', 'Mlk_Prod_NEalow', 'An_RDPbal_g', 
-                           'Du_MiCP_g']
-
-            df_lac_snapshot = (
-                get_vars_as_df(vars_return, NASEM_out())
-                .drop(columns='Model Variable')
-                .reindex(columns=['Description', 'Value']))
-            return df_lac_snapshot
-               
-        elif animal_input_reactives()['An_StatePhys']() == 'Dry Cow':
-            vars_return = ['An_MEIn', 'Trg_MEuse', 'An_MEbal', 'An_MPIn_g', 
-                           'An_MPuse_g_Trg', 'An_MPBal_g_Trg','An_RDPIn_g', 
-                           'Du_MiCP_g','An_RDPbal_g', 'An_DCADmeq']
-            
-            df_dry_snapshot = (
-                get_vars_as_df(vars_return, NASEM_out())
-                .drop(columns='Model Variable')
-                .reindex(columns=['Description', 'Value'])
-                )
-            return df_dry_snapshot
-        
-        else:
-            return pd.DataFrame()
+        return get_model_snapshot(model_values(), animal_input_reactives()['An_StatePhys']())
 
 
     @render.data_frame
@@ -454,38 +425,36 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
         return prepare_df_render(df_model_snapshot(), 10, 90, cols_longer=['Description'])
 
 
+    @reactive.Calc
+    def feed_nutrient_matrix():
+        return FeedNutrientMatrix(user_selected_feed_library())
+
+    # The diet composition is shown straight away from the feed library when kg
+    # are changed, then replaced by the model output once the model has run
+    diet_composition = reactive.Value(None)
+
+    @reactive.Effect
+    def _():
+        # Also when the diet returns to that of the newest run, which isn't run again
+        model_run_repeated()
+        diet_composition.set(model_values())
+
+    @reactive.Effect
+    def _():
+        diet_composition.set(feed_nutrient_matrix().diet_composition(get_user_diet()))
+
     @render.data_frame
-    @reactive.event(NASEM_out)
     def snapshot_diet_data_model():
         '''
         A snapshot of the diet composition
         '''
-        df = display_diet_values(NASEM_out(), is_snapshot=True)
+        req(diet_composition() is not None, get_diet_total_intake() > 0)
+        df = display_diet_values(diet_composition(), is_snapshot=True)
         return prepare_df_render(df, 1, 90, cols_longer='Component') 
 
 
-    @reactive.Effect
-    # @reactive.event(user_kgs)
-    def _():
-        total_intake = get_diet_total_intake()
-        for kg_id, perc_id in zip(user_kgs(), user_percs()):
-            kg_value = getattr(input, kg_id)()
-
-            if total_intake > 0 and kg_value is not None:
-                perc_value = (kg_value / total_intake) * 100
-                perc_value = float(f"{perc_value:.3g}") # 3 significant figures
-            else:
-                perc_value = 0
-            ui.update_numeric(id=perc_id, value=perc_value, min=0)
-
-    @reactive.effect
-    async def _():
-            perc_IDs = [session.ns(p) for p in user_percs()]
-            # req(all([await session.run_js(f"document.getElementById('{el_id}') !== null") for el_id in perc_IDs]))
-
-            await session.send_custom_message("disableUIList", {
-                    "UIObjectIds": perc_IDs
-                })
+    # The % DM of each feed is calculated from the kg DM inputs in the browser,
+    # see updateDietPercentages() in www/custom.js
             
     ########################################
     # reset diet and reload from usr session
@@ -516,9 +485,9 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
         
 
     @reactive.effect
-    @reactive.event(session_upload_ModOut)
-    def _():
-        '''If usr uploads pickle session file, replace diet from previous session. '''
+    @reactive.event(session_upload_diet)
+    async def _():
+        '''If usr uploads a session file, replace diet from previous session. '''
 
         if reset_flag() == False:
             m = ui.modal(
@@ -528,37 +497,10 @@ def diet_server(input: Inputs, output: Outputs, session: Session,
             )
             ui.modal_show(m)
 
-        elif session_upload_ModOut() is not None and isinstance(session_upload_ModOut(), nd.ModelOutput):
-
-
-            # # disable demo diet:
-
-
-
+        elif session_upload_diet() is not None and isinstance(session_upload_diet(), pd.DataFrame):
             # # re-populate diet
-            user_diet = session_upload_ModOut().get_value('user_diet')
-            # strip white space from column names (seems to add spaces after Feedstuff when an ingredient is missing
-            user_diet.columns = user_diet.columns.str.strip()
-
-            # Handle the first entry manually
-            first_entry = user_diet.iloc[0]
-            ui.update_selectize(id='item_1', choices=unique_fd_list(), selected=first_entry['Feedstuff'])
-            ui.update_numeric(id='kg_1', value=first_entry['kg_user'], min=0)
-
-            # print(f'test: {user_feeds()}')
-            # Iterate over the remaining entries
-            for index, row in user_diet.iloc[1:].iterrows():
-                # print(user_feeds())
-                feed_selected.set(row['Feedstuff'])
-                kg_selected.set(row['kg_user'])
-                perc_selected.set(0)
-                iterate_new_ingredient()
-            # print('done')
-
-            # reset helpers before finishing
-            feed_selected.set(None)
-            kg_selected.set(0)
-            perc_selected.set(0)
+            user_diet = session_upload_diet()
+            await add_feeds(list(zip(user_diet['Feedstuff'].tolist(), user_diet['kg_user'].tolist())))
             
         else:
             #not sure if this is possible
@@ -4,9 +4,16 @@ from shiny import Inputs, Outputs, Session, module, render, ui, module, reactive
 # from ipydatagrid import DataGrid
 from faicons import icon_svg
 import io
+import math
 import htmltools
 
-from utils import get_teaching_feeds, rename_df_cols_Fd_to_feed, pad_cols_UI_df, feed_library_default
+from utils import rename_df_cols_Fd_to_feed, pad_cols_UI_df, get_feed_library_default, debounce
+from feed_library_index import FeedLibraryIndex
+from model_runner import env_int
+
+# Libraries with more rows than this are paged, sorted and searched on the server
+# rather than sending every row to the browser
+feed_library_paging_rows = env_int('NASEM_FEED_LIBRARY_PAGING_ROWS', 2000)
 
 @module.ui
 def feed_library_ui():
@@ -56,6 +63,7 @@ def feed_library_ui():
                             ),
                     ),
                         ui.output_data_frame('datagrid_feed_library'),
+                        ui.output_ui('feed_library_pager'),
                         full_screen=True
                     )
                 
@@ -119,31 +127,40 @@ def feed_library_server(input: Inputs, output: Outputs, session: Session, feed_l
 
     session_library = reactive.value(feed_library_initial)
 
-    @render.ui
-    def set_usr_session_library():
-        '''If usr uploads pickle session file, replace default library with previous sessoin library. Still allows additional upload of new library.'''
+    @reactive.Effect
+    def _():
+        '''
+        If usr uploads session file, replace default library with previous session library. Still allows additional upload of new library.
+        This is an effect rather than part of the output below, so the library is restored with the 
+        rest of the session even when the Feed Library tab isn't open.
+        '''
         if session_upload_library() is not None and isinstance(session_upload_library(), pd.DataFrame):
             print("using library restored from .NDsession")
             session_library.set(session_upload_library())
-
-            # Add UI message to remind that using library from restored session
-            return ui.span('Library has been restored from .NDsession. A new custom library can still be uploaded.', style='color:darkred; font-style:italic; margin-left:40px')
         else:
             #not sure if this is possible
             print("restore default library")
             session_library.set(feed_library_initial)
-            return ui.TagList
+
+    @render.ui
+    def set_usr_session_library():
+        if session_upload_library() is not None and isinstance(session_upload_library(), pd.DataFrame):
+            # Add UI message to remind that using library from restored session
+            return ui.span('Library has been restored from .NDsession. A new custom library can still be uploaded.', style='color:darkred; font-style:italic; margin-left:40px')
+        return ui.TagList()
         
     # @reactive.effect
     # def _():
     #     print(session_library.get())
 
+    @reactive.Calc
+    def session_library_index():
+        return FeedLibraryIndex(session_library.get())
+
     @reactive.Calc
     def user_selected_feed_library():
         if input.use_teaching_fd_library():
-            teaching_feeds =  get_teaching_feeds()
-
-            df_user_lib = session_library.get().query('Fd_Name.isin(@teaching_feeds)')
+            df_user_lib = session_library.get().iloc[session_library_index().teaching_rows]
             return df_user_lib
         
             
@@ -200,6 +217,11 @@ def feed_library_server(input: Inputs, output: Outputs, session: Session, feed_l
 
     # df_feed_lib_userfriendly.loc[:,'Feed DM':'Feed WSC']
     
+    @reactive.Calc
+    def feed_library_index():
+        '''Column groups and calf feeds are found once for each library'''
+        return FeedLibraryIndex(user_selected_feed_library())
+
     @reactive.Calc
     def df_feed_lib_userfriendly():
         '''
@@ -208,57 +230,23 @@ def feed_library_server(input: Inputs, output: Outputs, session: Session, feed_l
             - Commonly used refers to ID columns + DM, DE_Base, ADF, NDF, CP, RUP, NPN_CP, Ash, Ca, P, Mg
         - Remove all feeds related to calves e.g. milk or calf starter
         '''
-
-        # calves:        
-        if input.hide_calf_feeds() == True:
-            df_calf_filter = (
-                df_feed_library()
-                .query("`Feed Category` != 'Calf Liquid Feed'")
-                .query("`Feed Name`" + ".str.contains('Calf', case=False, na=False) == False")
-        ) 
-        else:
-            df_calf_filter = df_feed_library()
-
-        # split dataframe into their groups
-        df_ID = df_calf_filter.loc[:,['Feed Name','Feed Category', 'Feed Type']]
-
-        if input.cols_common() == True:
-            df_common = df_calf_filter.loc[:,['Feed DM', 'Feed DE_Base', 'Feed ADF', 'Feed NDF', 'Feed DNDF48_NDF', 'Feed CP', 'Feed RUP_base', 'Feed NPN_CP', 'Feed Ash', 'Feed Ca', 'Feed P', 'Feed Mg', 'Feed K']]
-        else:
-            df_common = pd.DataFrame()
-
-        
-        if input.cols_amino_acids() == True:
-            df_AA = df_calf_filter.loc[:,'Feed Arg_CP':'Feed Val_CP']
-        else:
-            df_AA = pd.DataFrame()
-        
-        if input.cols_fatty_acids() == True:
-            df_FA = df_calf_filter.loc[:,'Feed CFat':'Feed OtherFA_FA'].drop('Feed Ash', axis =1)
-        else:
-            df_FA = pd.DataFrame()
-        
-        if input.cols_vitamins() == True:
-            df_vit = df_calf_filter.loc[:,'Feed B_Carotene':'Feed VitE']
-        else:
-            df_vit = pd.DataFrame()
-
-        if input.cols_minerals() == True:
-            if input.cols_common() == True:
-                df_minerals = df_calf_filter.loc[:,'Feed Ca':'Feed Zn'].drop(['Feed Ca', 'Feed P', 'Feed Mg', 'Feed K'], axis=1)
-            else:
-                df_minerals = df_calf_filter.loc[:,'Feed Ca':'Feed Zn']
-        else:
-            df_minerals = pd.DataFrame()
-
-
         if input.cols_show_all() == True:
-            df_out = df_calf_filter
+            groups = None
         else:
-            df_out = df_ID.join([df_common, df_AA, df_FA, df_vit, df_minerals])
-
-        
-        return df_out
+            selected_groups = {
+                'common': input.cols_common(),
+                'amino_acids': input.cols_amino_acids(),
+                'fatty_acids': input.cols_fatty_acids(),
+                'vitamins': input.cols_vitamins(),
+                'minerals': input.cols_minerals(),
+            }
+            groups = ['id'] + [group for group, selected in selected_groups.items() if selected]
+
+        return feed_library_index().view(
+            df_feed_library(), 
+            groups, 
+            hide_calf_feeds=input.hide_calf_feeds()
+            )
 
     
 
@@ -279,56 +267,132 @@ def feed_library_server(input: Inputs, output: Outputs, session: Session, feed_l
     # def grid_feed_library():
     #     return datagrid_feed_lib()
     
+    ########################
+    # Server-side paging for large libraries
+    # Only the current page is sent to the browser. Searching and sorting are 
+    # done here because the grid's own filters would only apply to one page.
+
+    @reactive.Calc
+    def use_paging() -> bool:
+        return len(df_feed_lib_userfriendly()) > feed_library_paging_rows
+
+    @render.ui
+    def feed_library_pager():
+        if not use_paging():
+            return ui.TagList()
+
+        # Later changes to the shown columns are applied by the effect below, 
+        # rather than re-creating the pager
+        with reactive.isolate():
+            columns = list(df_feed_lib_userfriendly().columns)
+
+        return ui.div(
+            ui.input_text('page_search', None, placeholder='Search feed names', width='250px'),
+            ui.input_select('page_sort', None, choices=columns, selected='Feed Name', width='200px'),
+            ui.input_switch('page_sort_desc', 'Descending'),
+            ui.input_select('page_size', None, choices=['100', '250', '500'], width='100px'),
+            ui.input_action_button('page_prev', icon_svg('chevron-left'), class_='btn-sm'),
+            ui.output_text('page_label', inline=True),
+            ui.input_action_button('page_next', icon_svg('chevron-right'), class_='btn-sm'),
+            style='display: flex; gap: 10px; align-items: center; flex-wrap: wrap; margin-top: 10px;'
+        )
+
+    @reactive.effect
+    def _():
+        req(use_paging())
+        columns = list(df_feed_lib_userfriendly().columns)
+        with reactive.isolate():
+            # page_sort doesn't exist yet when the pager is first rendered
+            selected = input.page_sort() if 'page_sort' in input else 'Feed Name'
+            if selected not in columns:
+                selected = 'Feed Name'
+        ui.update_select('page_sort', choices=columns, selected=selected)
+
+    @debounce(0.3)
+    @reactive.Calc
+    def page_search():
+        return input.page_search().strip()
+
+    @reactive.Calc
+    def df_feed_lib_sorted():
+        '''The filtered and sorted library, before splitting into pages'''
+        df = df_feed_lib_userfriendly()
+        if not use_paging():
+            return df
+
+        if page_search():
+            df = df[df['Feed Name'].str.contains(page_search(), case=False, regex=False, na=False)]
+        if input.page_sort() in df.columns:
+            df = df.sort_values(input.page_sort(), ascending=not input.page_sort_desc(), kind='stable')
+        return df
+
+    current_page = reactive.Value(1)
+
+    @reactive.Calc
+    def n_pages() -> int:
+        return max(1, math.ceil(len(df_feed_lib_sorted()) / int(input.page_size())))
+
+    @reactive.effect
+    @reactive.event(page_search, input.page_sort, input.page_sort_desc, input.page_size)
+    def _():
+        current_page.set(1)
+
+    @reactive.effect
+    @reactive.event(input.page_prev)
+    def _():
+        current_page.set(max(1, current_page() - 1))
+
+    @reactive.effect
+    @reactive.event(input.page_next)
+    def _():
+        current_page.set(min(n_pages(), current_page() + 1))
+
+    @render.text
+    def page_label():
+        return f"Page {min(current_page(), n_pages())} of {n_pages()} ({len(df_feed_lib_sorted())} feeds)"
+
+    @reactive.Calc
+    def df_feed_lib_page():
+        '''The rows shown in the grid'''
+        if not use_paging():
+            return df_feed_lib_userfriendly()
+        
+        page_size = int(input.page_size())
+        start = (min(current_page(), n_pages()) - 1) * page_size
+        return df_feed_lib_sorted().iloc[start:start + page_size]
+
+
     @render.data_frame
     def datagrid_feed_library():
-        df = df_feed_lib_userfriendly().copy()
+        df = df_feed_lib_page()
         #pad column names to extend width. The \u00A0 is a non-breaking space (as spaces are being stripped by DataGrid)
         df = pad_cols_UI_df(df, 25, n_length_longer=70, cols_longer=['Feed Name'])
-        return render.DataGrid(df, selection_mode="rows", editable=False, filters=True)
+        return render.DataGrid(df, selection_mode="rows", editable=False, filters=not use_paging())
 
     ########################
     # Get the user selections from DataGrid
-    # These should be stored to a reactive list so that they aren't lost if table filters change
+    # These are stored as feed names in a reactive list so that they aren't lost 
+    # if table filters or pages change
 
     # initiliase reactive value that contains a list
-    feed_library_index_stored = reactive.Value([])
-
-    @reactive.Calc
-    def prepare_user_selected_feed_names():
-        '''
-        Handles the specific selections from a datagrid to return a dataframe that is rendered 
-        in the sidepanel to show users which feeds they've selected. 
-        This is useful when building diets.
-        '''
-        # This is shiny version of writing this: datagrid_feed_lib.selections
-        # or selected_cells, etc.
-        # row_selections = reactive_read(datagrid_feed_lib(), "selections")
-
-        # row_selections = datagrid_feed_library().input_cell_selection()["rows"] 
-        # row_index = [list(range(row_number['r1'], row_number['r2']+1)) for row_number in row_selections]
-        # flattened_index = [i for row in row_index for i in row]
-
-        flattened_index = datagrid_feed_library.cell_selection()["rows"]
-
-        return(flattened_index)
-        # return(fd_lib_stored_copy)
-        # return(feed_library_index_stored)
-    
+    feed_names_stored = reactive.Value([])
     
+    # Only runs when the browser sends a new selection. cell_selection() is also 
+    # invalidated when the grid is re-rendered, which would apply the previous 
+    # selection to the rows of a new page
     @reactive.Effect
+    @reactive.event(input.datagrid_feed_library_cell_selection)
     def _():
-        # This take a dependency on the user selection, which updates every time a cell is clicked
-        prepare_user_selected_feed_names()
+        selected_rows = list(datagrid_feed_library.cell_selection()["rows"])
         
-        # then, execute this code but preventing other code taking a dependency on it - prevents infinite loop
-        with reactive.isolate():
-            fd_lib_stored_copy = feed_library_index_stored().copy()
-
-            # add on user selected feed names to reactive list
-            fd_lib_stored_copy.extend(prepare_user_selected_feed_names())
-            
-            # remove duplicates (by converting to set) and then set the reactiveValue as this new list
-            feed_library_index_stored.set(list(set(fd_lib_stored_copy)))
+        # rows are numbered from the start of the data sent to the grid (i.e. the current page)
+        selected_names = df_feed_lib_page()['Feed Name'].iloc[selected_rows].to_list()
+        
+        # add on user selected feed names to reactive list, without duplicates
+        stored = feed_names_stored()
+        new_names = [name for name in dict.fromkeys(selected_names) if name not in stored]
+        if new_names:
+            feed_names_stored.set(stored + new_names)
 
 
     @reactive.Effect
@@ -336,15 +400,18 @@ def feed_library_server(input: Inputs, output: Outputs, session: Session, feed_l
     @reactive.event(user_selections_reset)
     def _():
         ''' Reset the user selections from DataGrid clicking events. Clears the list in UI.'''
-        feed_library_index_stored.set([])
+        feed_names_stored.set([])
 
 
     @reactive.Calc
     def user_selected_feeds():
-        df = (df_feed_lib_userfriendly()
-               .reset_index(drop = True) # reset's index to match a 'row number' from selection with index (after filtering)
-               .loc[feed_library_index_stored(),'Feed Name'])
-        return df
+        # Feeds that aren't in the current library (e.g. after switching to teaching feeds) are skipped
+        library_feeds = set(user_selected_feed_library()['Fd_Name'])
+        return pd.Series(
+            [name for name in feed_names_stored() if name in library_feeds], 
+            name='Feed Name', 
+            dtype=object
+            )
 
     
     ################################
@@ -372,7 +439,7 @@ def feed_library_server(input: Inputs, output: Outputs, session: Session, feed_l
     def download_lib_default():
         # Use io.BytesIO to yield the csv content 
         with io.StringIO() as buf:  # Use io.StringIO for string data
-            feed_library_default.to_csv(buf)
+            get_feed_library_default().to_csv(buf)
             # buf.write()
             yield buf.getvalue()
     
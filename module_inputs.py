@@ -1,11 +1,15 @@
-import pandas as pd
+import time
 from shiny import Inputs, Outputs, Session, module, render, ui, module, reactive, req
 # from shinywidgets import output_widget, render_widget, reactive_read
 # from ipydatagrid import DataGrid
-import pickle
-import nasem_dairy as nd
 import htmltools
 
+from session_file import read_session
+
+# Seconds to wait for the browser to confirm that a session has been restored,
+# after which the model is run with whatever inputs it has
+session_restore_timeout_secs = 10
+
 @module.ui
 def animal_inputs_ui():
     return ([
@@ -424,20 +428,23 @@ def animal_inputs_server(input: Inputs, output: Outputs, session: Session, user_
                 selector = "#milk_production_conditional_panel", # place the new UI's below the initial item input
                 where = "afterEnd")
             
-            ui.update_numeric('An_GestDay', value = 250)
-            ui.update_numeric('Trg_FrmGain', value = 0.1)
-            ui.update_numeric('Trg_RsrvGain', value = 0)
-            ui.update_numeric('Trg_MilkProd', value = 0)
+            # A restored session has its own values, rather than the defaults
+            if not restoring_session():
+                ui.update_numeric('An_GestDay', value = 250)
+                ui.update_numeric('Trg_FrmGain', value = 0.1)
+                ui.update_numeric('Trg_RsrvGain', value = 0)
+                ui.update_numeric('Trg_MilkProd', value = 0)
         
         elif animal_input_reactives()['An_StatePhys']() == 'Lactating Cow':
             ui.update_selectize('DMIn_eqn', selected='9')
 
             ui.remove_ui(selector="div#drycow_input_warning")
             
-            ui.update_numeric('An_GestDay', value = 46)
-            ui.update_numeric('Trg_FrmGain', value = 0)
-            ui.update_numeric('Trg_RsrvGain', value = 0)
-            ui.update_numeric('Trg_MilkProd', value = 35)
+            if not restoring_session():
+                ui.update_numeric('An_GestDay', value = 46)
+                ui.update_numeric('Trg_FrmGain', value = 0)
+                ui.update_numeric('Trg_RsrvGain', value = 0)
+                ui.update_numeric('Trg_MilkProd', value = 35)
     
     ########################
     # Load session file
@@ -449,21 +456,14 @@ def animal_inputs_server(input: Inputs, output: Outputs, session: Session, user_
         print(pkl_input[0])
         file_path = pkl_input[0]["datapath"]
         with open(file_path, 'rb') as f:
-            pkl_dict = pickle.load(f)
-
-        # Check pickle file
-        if not isinstance(pkl_dict, dict) or 'ModelOutput' not in pkl_dict or not isinstance(pkl_dict['ModelOutput'], nd.ModelOutput):
-            m = ui.modal(
-                ui.p('The uploaded file does not contain a valid ModelOutput entry. Please try again.'),
-                title='Upload failed',
-                easy_close=True,
-            )
-            ui.modal_show(m)
-            return {}
+            data = f.read()
 
-        if 'FeedLibrary' not in pkl_dict or not isinstance(pkl_dict['FeedLibrary'], pd.DataFrame):
+        # Check session file
+        try:
+            session_dict = read_session(data)
+        except ValueError as e:
             m = ui.modal(
-                ui.p('The uploaded file does not contain a valid Feed Library entry. Please try again.'),
+                ui.p(f'{e} Please try again.'),
                 title='Upload failed',
                 easy_close=True,
             )
@@ -471,7 +471,9 @@ def animal_inputs_server(input: Inputs, output: Outputs, session: Session, user_
             return {}
         
         ui.notification_show('.NDsession upload successful', type='message')
-        return pkl_dict
+        for warning in session_dict['Warnings']:
+            ui.notification_show(warning, type='warning', duration=None)
+        return session_dict
     
         
     @render.ui
@@ -497,22 +499,41 @@ def animal_inputs_server(input: Inputs, output: Outputs, session: Session, user_
 
     # Unpack session dictionary
     def session_upload_library():
-        return pkl_session_upload()['FeedLibrary']
+        return pkl_session_upload().get('FeedLibrary')
 
-    def session_upload_ModelOuput():
-        return pkl_session_upload()['ModelOutput']
+    def session_upload_diet():
+        return pkl_session_upload().get('user_diet')
     
     ##############################
     # Update ui from session file
     ##############################
-    @reactive.Effect
+    # A session is restored as one transaction: the model isn't run while its
+    # inputs are being applied, but once the browser confirms it has them all
+    # (see session_restored() in app.py). Holds when the restore started, or None.
+    session_restore = reactive.Value(None)
+
+    def restoring_session() -> bool:
+        with reactive.isolate():
+            return session_restore() is not None
+
+    @reactive.Calc
+    def session_restored() -> bool:
+        return session_restore() is None
+
+    # Runs before the diet and feed library are restored from the same upload
+    @reactive.Effect(priority=1)
     def _():
-        usr_ModOut = session_upload_ModelOuput()
+        session_dict = req(pkl_session_upload())
+        restore_started = time.time()
+        session_restore.set(restore_started)
+
+        # The inputs returned by the model when the session was saved
+        usr_inputs = {**session_dict['animal_input'], **session_dict['equation_selection']}
 
         selectize_ids = ['An_StatePhys', 'An_Breed']
 
         for var_name in selectize_ids:
-            val = usr_ModOut.get_value(var_name)
+            val = usr_inputs.get(var_name)
             ui.update_selectize(var_name, selected=val)
 
 
@@ -526,7 +547,7 @@ def animal_inputs_server(input: Inputs, output: Outputs, session: Session, user_
         ]
 
         for var_name in numeric_ids:
-            val = usr_ModOut.get_value(var_name)
+            val = usr_inputs.get(var_name)
             ui.update_numeric(var_name, value=val)
 
 
@@ -537,19 +558,46 @@ def animal_inputs_server(input: Inputs, output: Outputs, session: Session, user_
             'Use_DNDF_IV', 'Monensin_eqn', 'NonMilkCP_ClfLiq', 'RumDevDisc_Clf'
         ]
         for var_name in radio_buttons:
-            val = usr_ModOut.get_value(var_name)
+            val = usr_inputs.get(var_name)
             ui.update_radio_buttons(var_name, selected=val)
 
         # special cases:
         # special_cases = ['An_Parity_percent_first', 'An_AgeMonth']
-        An_Parity_percent_first = (2 - usr_ModOut.get_value('An_Parity_rl')) * 100
+        An_Parity_percent_first = (2 - usr_inputs.get('An_Parity_rl')) * 100
         ui.update_numeric('An_Parity_percent_first', value = An_Parity_percent_first)
 
-        An_AgeMonth =  usr_ModOut.get_value('An_AgeDay')/30.3
+        An_AgeMonth =  usr_inputs.get('An_AgeDay')/30.3
         ui.update_numeric('An_AgeMonth',value = An_AgeMonth)
         
 
         ui.notification_show('Inputs re-loaded from uploaded .NDsession successfully', type='message')
 
+        # Sent after the input updates above, so the browser replies once it has
+        # applied them and sent back the new input values (see www/custom.js)
+        async def confirm_restore():
+            await session.send_custom_message('sessionRestored', {
+                'id': session.ns('session_restored'), 'restore': restore_started
+                })
+        session.on_flushed(confirm_restore, once=True)
+
+    # After the Dry Cow UI setup, which may be run in the same flush
+    @reactive.Effect(priority=-1)
+    @reactive.event(input.session_restored)
+    def _():
+        if input.session_restored() == session_restore():
+            session_restore.set(None)
 
-    return(animal_input_dict, animal_input_reactives, equation_selection, session_upload_library, session_upload_ModelOuput)
+    @reactive.Effect
+    def _():
+        restore_started = session_restore()
+        if restore_started is None:
+            return
+        remaining = restore_started + session_restore_timeout_secs - time.time()
+        if remaining > 0:
+            reactive.invalidate_later(remaining)
+        else:
+            print("No reply from the browser, finishing the .NDsession restore")
+            session_restore.set(None)
+
+
+    return(animal_input_dict, animal_input_reactives, equation_selection, session_upload_library, session_upload_diet, session_restored)
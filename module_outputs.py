@@ -3,14 +3,14 @@
 from shiny import Inputs, Outputs, Session, module, render, ui, module, reactive, req
 import pandas as pd
 from datetime import date
-import io
-import pickle
 from datetime import datetime
 
 from version import __version__
-from utils import display_diet_values, get_vars_as_df, get_clean_vars, prepare_df_render, coerce_non_text_to_numeric
-from generate_report import generate_summary_report, generate_full_report
-import nasem_dairy as nd
+from utils import display_diet_values, prepare_df_render, coerce_non_text_to_numeric, get_output_variables, debounce, compare_animal_inputs
+from session_file import write_session
+from generate_report import summary_report_tables, iter_summary_report, iter_full_report, full_report_table_names
+
+search_debounce_ms = 250
 
 @module.ui
 def outputs_ui():
@@ -103,6 +103,7 @@ def outputs_ui():
 @module.server
 def outputs_server(input: Inputs, output: Outputs, session: Session, 
                    NASEM_out, 
+                   model_values,
                    user_selected_feed_library,
                    animal_input_dict,
                    df_model_snapshot
@@ -113,39 +114,38 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
     ######################################################
     @reactive.Calc
     def df_key_model_data_milk():
-        vars_return = ['Mlk_Prod_comp', 'MlkFat_Milk_p', 'MlkNP_Milk_p']
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['milk']
+        return model_values().get_vars_as_df(vars_return)
 
     @reactive.Calc
     def df_key_model_data_allowable_milk():
-        vars_return = ['Mlk_Prod_MPalow', 'Mlk_Prod_NEalow']
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['allowable_milk']
+        return model_values().get_vars_as_df(vars_return)
 
     @reactive.Calc
     def df_key_model_data_ME():
-        vars_return = ['An_MEIn', 'Trg_MEuse', 'An_NEIn']
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['ME']
+        return model_values().get_vars_as_df(vars_return)
 
     @reactive.Calc
     def df_key_model_data_MP():
-        vars_return = ['An_MPIn', 'An_MPuse_kg_Trg']
-
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['MP']
+        return model_values().get_vars_as_df(vars_return)
 
     @reactive.Calc
     def df_key_model_data_DCAD():
-        vars_return = ['An_DCADmeq']
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['DCAD']
+        return model_values().get_vars_as_df(vars_return)
 
     @reactive.Calc
     def df_key_model_data_NEL():
-        vars_return = ['An_NE', 'An_NEIn']
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['NEL']
+        return model_values().get_vars_as_df(vars_return)
 
     @reactive.Calc 
     def df_key_model_data_energy_teaching():
-        vars_return = ['Trg_MEuse', 'An_MEmUse', 'An_MEgain', 'Gest_MEuse', 'Trg_Mlk_MEout', 'An_MEIn', 'Frm_NEgain', 'Rsrv_NEgain', 'GrUter_BWgain', 'An_MEIn', 'Mlk_Prod_NEalow', 'An_MEavail_Milk']
-        return get_vars_as_df(vars_return, NASEM_out())
+        vars_return = get_output_variables()['energy_teaching']
+        return model_values().get_vars_as_df(vars_return)
 
     ######################################################
     # Render tables for UI
@@ -181,7 +181,7 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
 
     @render.data_frame
     def diet_summary_model():
-        df = display_diet_values(NASEM_out())
+        df = display_diet_values(model_values())
         return prepare_df_render(df, 10, 80, cols_longer='Component')
      
     @render.data_frame
@@ -196,15 +196,7 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
     
     @reactive.Calc
     def df_user_input_compare() -> pd.DataFrame:
-        df_user_input_SHINY = pd.DataFrame(animal_input_dict().items(), columns=['Variable Name', 'Value_SHINY'])
-        df_user_input_RETURN = pd.DataFrame(NASEM_out().get_value('animal_input').items(), columns=['Variable Name', 'Value_Model_Return'])
-
-        df_user_input_compare = df_user_input_SHINY.merge(
-            df_user_input_RETURN,
-            on='Variable Name',
-            how='outer')
-
-        return df_user_input_compare
+        return compare_animal_inputs(animal_input_dict(), NASEM_out())
 
      
     @render.data_frame
@@ -231,14 +223,15 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
         df = coerce_non_text_to_numeric(NASEM_out().get_report('table7_2'), 2)
         return prepare_df_render(df, cols_longer=None, use_DataTable=False)
 
-    @render.download(filename=lambda: f"NASEM_report-{date.today().isoformat()}.html")
-    def btn_download_report():
-        html_out = generate_summary_report(
+    # The report tables are converted to HTML once per model run
+    @reactive.Calc
+    def summary_report_tables_html():
+        return summary_report_tables(
             df_milk=df_key_model_data_milk(),
             df_allowable_milk=df_key_model_data_allowable_milk(),
             df_ME=df_key_model_data_ME(),
             df_MP=df_key_model_data_MP(),
-            df_diet_summary=display_diet_values(NASEM_out()),
+            df_diet_summary=display_diet_values(model_values()),
             df_DCAD=df_key_model_data_DCAD(),
             df_NEL=df_key_model_data_NEL(),
             df_ration_ingredients=NASEM_out().get_value('user_diet'),
@@ -249,31 +242,22 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
             # df_snapshot=df_model_snapshot() if animal_input_reactives()['An_StatePhys']() == 'Lactating Cow' else df_model_snapshot_drycow()
         )
 
-        with io.StringIO() as buf:
-            buf.write(html_out)
-            yield buf.getvalue()
+    @render.download(filename=lambda: f"NASEM_report-{date.today().isoformat()}.html")
+    def btn_download_report():
+        # Sent to the browser in chunks, as each is made
+        yield from iter_summary_report(summary_report_tables_html())
 
 
     @render.download(filename=lambda: f"NASEM-report-all-tables-{date.today().isoformat()}.html")
     def btn_download_full_report_tables():
-        table_names = [
-            "table1_1", "table1_2", "table1_3b", "table2_1", "table2_2", 
-            "table3_1", "table4_1", "table4_2", "table4_3", "table5_1", 
-            "table6_1", "table6_2", "table6_3", "table6_4", "table6_5", 
-            "table7_1", "table7_2", "table7_3", "table8_1", "table8_2"
-        ]
-
-        # Assuming `model_output` is an instance of `nd.ModelOutput`
-        html_report = generate_full_report(NASEM_out(), table_names)
-        
-        with io.StringIO() as buf:
-            buf.write(html_report)
-            yield buf.getvalue()
+        # Sent to the browser in chunks, with each table sent as it is made.
+        # Tables are kept for each model output, so repeat downloads don't remake them
+        yield from iter_full_report(NASEM_out(), full_report_table_names)
 
 
     #######################
     # Save Session file 
-    # a pickle file using the .NDsession extension
+    # a zip file using the .NDsession extension
 
     # Download handler
     @render.download(filename = lambda: f"NASEM_simulation-{date.today().isoformat()}.NDsession")
@@ -283,27 +267,32 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
         # Format the date and time as a string
         formatted_datetime = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        output_dict = {
-            'ModelOutput' : NASEM_out(),
-            'FeedLibrary' : user_selected_feed_library(),
-            'SaveTime': formatted_datetime,
-            "AppVersion": __version__,
-            "ndVersion": nd.__version__
-        }
-        with io.BytesIO() as buf:
-            pickle.dump(output_dict, buf)
-            yield buf.getvalue()
+        # The inputs of this model run are saved, see session_file.py
+        yield write_session(
+            user_diet=NASEM_out().get_value('user_diet'),
+            animal_input=NASEM_out().get_value('animal_input'),
+            equation_selection=NASEM_out().get_value('equation_selection'),
+            feed_library=user_selected_feed_library(),
+            save_time=formatted_datetime,
+            app_version=__version__
+            )
 
     ################################
     # Model Search
     ################################
+    # Search once typing stops
+    @debounce(search_debounce_ms / 1000)
+    @reactive.Calc
+    def search_term():
+        return input.ModOut_search().strip()
+
     @render.data_frame
     def ModOut_search_return():
         req(NASEM_out())
-        if len(input.ModOut_search()) == 0:
+        if len(search_term()) == 0:
             return pd.DataFrame({})
         else:
-            df = NASEM_out().search(input.ModOut_search())
+            df = model_values().search(search_term())
             if df.empty:
                 return pd.DataFrame({})
             else:
@@ -314,19 +303,7 @@ def outputs_server(input: Inputs, output: Outputs, session: Session,
         req(NASEM_out())
         
         if input.show_all_output():
-             # Function to filter the dictionary to keep only numerical values
-            def filter_dict(data):
-                return {k: v for k, v in data.items() if isinstance(v, (int, float))}
-
-            # Filter the dictionary
-            filtered_dict = filter_dict(NASEM_out().export_to_dict())
-    
-            filtered_data = {var: get_clean_vars(var, NASEM_out()) for var in filtered_dict}
-            
-
-
-            # Convert the filtered dictionary to a DataFrame
-            df = pd.DataFrame.from_dict(filtered_data, orient="index", columns=['Value']).reset_index(names="Name")
+            df = model_values().table[['Value', 'Description']].reset_index(names="Name")
             return render.DataGrid(df, summary=False, filters=True)
 
     
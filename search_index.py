@@ -0,0 +1,54 @@
+# search_index.py
+'''
+Substring search over a list of records, used for the feed dropdowns on the
+Diet tab (see feed_search.py) and the variable search on the Outputs tab (see
+model_values.py).
+
+Each record is indexed by the 1, 2 and 3 character substrings (n-grams) of
+its text fields, built once, so each search only checks records that contain
+the typed text.
+'''
+
+
+def ngrams(text: str, n_max: int = 3) -> set:
+    return {text[i:i + n] for n in range(1, n_max + 1) for i in range(len(text) - n + 1)}
+
+
+class NgramIndex:
+    '''
+    Index of `records`, each a tuple of lowercase text fields (e.g. a feed's
+    name and category). Records are referred to by their position.
+    '''
+    def __init__(self, records):
+        self._records = [tuple(record) for record in records]
+
+        # n-gram -> positions of records with it in any field.
+        # Each field is indexed separately so no n-grams span two fields.
+        postings = {}
+        for i, record in enumerate(self._records):
+            for gram in set().union(*(ngrams(field) for field in record)):
+                postings.setdefault(gram, []).append(i)
+        self._postings = {gram: frozenset(ids) for gram, ids in postings.items()}
+
+    def _candidates(self, keyword: str) -> frozenset:
+        '''Positions of records that may contain `keyword`, from its n-grams'''
+        if len(keyword) <= 3:
+            return self._postings.get(keyword, frozenset())
+        grams = sorted((keyword[i:i + 3] for i in range(len(keyword) - 2)),
+                       key=lambda gram: len(self._postings.get(gram, ())))
+        ids = self._postings.get(grams[0], frozenset())
+        for gram in grams[1:]:
+            if not ids:
+                break
+            ids = ids & self._postings.get(gram, frozenset())
+        return ids
+
+    def matches(self, keyword: str) -> set:
+        '''Positions of records with the lowercase `keyword` in any field'''
+        if len(keyword) <= 3:
+            # Indexed whole, so every candidate contains it
+            return set(self._candidates(keyword))
+        return {
+            i for i in self._candidates(keyword)
+            if any(keyword in field for field in self._records[i])
+            }
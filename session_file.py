@@ -0,0 +1,223 @@
+# session_file.py
+'''
+Reading and writing .NDsession files, which save the inputs of a simulation so
+it can be restored in the app (see the Inputs tab) or used by batch_reports.py.
+
+A session file is a zip archive of:
+- `session.json`: the format version, when and with which versions it was
+  saved, the animal inputs, equation selections and diet (kg DM of each feed)
+- `feed_library.parquet`: the feed library, only when it isn't the default
+  NASEM library (which is identified by its fingerprint instead)
+
+The model output isn't saved, as it is re-created by running the model with
+these inputs. Older session files were a pickled dictionary with the whole
+ModelOutput and feed library. Unpickling can run any code, so these are only
+read when NASEM_ALLOW_LEGACY_SESSIONS=1 is set. They can instead be converted
+to the current format offline:
+
+    python session_file.py old.NDsession new.NDsession
+'''
+import argparse
+import io
+import json
+import pickle
+import sys
+import zipfile
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import nasem_dairy as nd
+
+from model_runner import fingerprint_dataframe, env_int
+from utils import get_feed_library_default, create_user_diet
+
+session_format = 'NDsession'
+session_version = 2
+
+# Whether pickled session files (saved before version 2) can be uploaded
+allow_legacy_sessions = env_int('NASEM_ALLOW_LEGACY_SESSIONS', 0) > 0
+
+
+@cache
+def get_feed_library_default_fingerprint() -> str:
+    return fingerprint_dataframe(get_feed_library_default())
+
+
+def _json_default(value):
+    '''Converts the numpy values in model inputs for json.dumps()'''
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    raise TypeError(f"Can't save {type(value).__name__} in a session file")
+
+
+def write_session(user_diet: pd.DataFrame,
+                  animal_input: dict,
+                  equation_selection: dict,
+                  feed_library: pd.DataFrame,
+                  save_time: str,
+                  app_version: str) -> bytes:
+    '''
+    Returns the contents of a session file for the given model inputs (as
+    returned in the ModelOutput) and feed library.
+    '''
+    # strip white space from column names (seems to add spaces after Feedstuff when an ingredient is missing)
+    user_diet = user_diet.rename(columns=str.strip)
+    feed_library_fingerprint = fingerprint_dataframe(feed_library)
+    is_default_library = feed_library_fingerprint == get_feed_library_default_fingerprint()
+
+    session = {
+        'format': session_format,
+        'version': session_version,
+        'SaveTime': save_time,
+        'AppVersion': app_version,
+        'ndVersion': nd.__version__,
+        'animal_input': animal_input,
+        'equation_selection': equation_selection,
+        'diet': {
+            'Feedstuff': user_diet['Feedstuff'].tolist(),
+            'kg_user': user_diet['kg_user'].tolist()
+            },
+        'feed_library': {
+            'default': is_default_library,
+            'fingerprint': feed_library_fingerprint
+            }
+        }
+
+    with io.BytesIO() as buf:
+        with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('session.json', json.dumps(session, indent=2, default=_json_default))
+            if not is_default_library:
+                with io.BytesIO() as library_buf:
+                    feed_library.to_parquet(library_buf)
+                    archive.writestr('feed_library.parquet', library_buf.getvalue())
+        return buf.getvalue()
+
+
+def _read_zip_session(data: bytes) -> dict:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        try:
+            session = json.loads(archive.read('session.json'))
+        except (KeyError, ValueError) as e:
+            raise ValueError('The file does not contain valid session data.') from e
+
+        if session.get('format') != session_format:
+            raise ValueError('The file is not a .NDsession file.')
+        if session.get('version', 0) > session_version:
+            raise ValueError('The file was saved by a newer version of this app. Please update the app to load it.')
+
+        warnings = []
+        if session['feed_library']['default']:
+            feed_library = get_feed_library_default()
+            if session['feed_library']['fingerprint'] != get_feed_library_default_fingerprint():
+                warnings.append(
+                    'The default feed library has changed since the .NDsession was saved, '
+                    'so results may differ from the original simulation.'
+                    )
+        else:
+            with archive.open('feed_library.parquet') as f:
+                feed_library = pd.read_parquet(f)
+
+    return {
+        'SaveTime': session.get('SaveTime'),
+        'AppVersion': session.get('AppVersion'),
+        'ndVersion': session.get('ndVersion'),
+        'user_diet': create_user_diet(session['diet']['Feedstuff'], session['diet']['kg_user']),
+        'animal_input': session['animal_input'],
+        'equation_selection': session['equation_selection'],
+        'FeedLibrary': feed_library,
+        'Warnings': warnings
+        }
+
+
+def _read_pickle_session(data: bytes) -> dict:
+    '''Reads a session file saved before version 2 (a pickled dictionary)'''
+    # Only files from this app should be loaded, as unpickling can run code
+    try:
+        session = pickle.loads(data)
+    except Exception as e:
+        raise ValueError('The file does not contain valid session data.') from e
+
+    if not isinstance(session, dict) or not isinstance(session.get('ModelOutput'), nd.ModelOutput):
+        raise ValueError('The uploaded file does not contain a valid ModelOutput entry.')
+    if not isinstance(session.get('FeedLibrary'), pd.DataFrame):
+        raise ValueError('The uploaded file does not contain a valid Feed Library entry.')
+
+    model_output = session['ModelOutput']
+    user_diet = model_output.get_value('user_diet')
+    # strip white space from column names (seems to add spaces after Feedstuff when an ingredient is missing)
+    user_diet.columns = user_diet.columns.str.strip()
+
+    return {
+        'SaveTime': session.get('SaveTime'),
+        'AppVersion': session.get('AppVersion'),
+        'ndVersion': session.get('ndVersion'),
+        'user_diet': create_user_diet(user_diet['Feedstuff'].tolist(), user_diet['kg_user'].tolist()),
+        'animal_input': model_output.get_value('animal_input'),
+        'equation_selection': model_output.get_value('equation_selection'),
+        'FeedLibrary': session['FeedLibrary'],
+        'ModelOutput': model_output,
+        'Warnings': []
+        }
+
+
+def read_session(data: bytes, allow_legacy: bool | None = None) -> dict:
+    '''
+    Reads the contents of a session file. Returns a dictionary of 'user_diet',
+    'animal_input', 'equation_selection', 'FeedLibrary', 'SaveTime',
+    'AppVersion', 'ndVersion' and 'Warnings' (messages for the user). Older
+    files also have their 'ModelOutput', and are only read when `allow_legacy`
+    is True (defaults to NASEM_ALLOW_LEGACY_SESSIONS).
+
+    Raises ValueError if the file isn't a valid session file.
+    '''
+    if data[:4] == b'PK\x03\x04':
+        try:
+            return _read_zip_session(data)
+        except (zipfile.BadZipFile, KeyError, TypeError) as e:
+            raise ValueError('The file does not contain valid session data.') from e
+
+    if allow_legacy is None:
+        allow_legacy = allow_legacy_sessions
+    if not allow_legacy:
+        raise ValueError(
+            'The file is not a .NDsession file, or was saved by an older version of this app. '
+            'Older files can be converted with session_file.py.'
+            )
+    return _read_pickle_session(data)
+
+
+def convert_session(data: bytes) -> bytes:
+    '''Converts a session file saved before version 2 to the current format'''
+    session = read_session(data, allow_legacy=True)
+    return write_session(
+        session['user_diet'],
+        session['animal_input'],
+        session['equation_selection'],
+        session['FeedLibrary'],
+        session['SaveTime'],
+        session['AppVersion']
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Converts a .NDsession file saved by an older version of the app to the current format. Only convert files from a trusted source, as reading them can run code.')
+    parser.add_argument('input', type=Path, help='Older .NDsession file')
+    parser.add_argument('output', type=Path, help='Converted .NDsession file to write')
+    args = parser.parse_args(argv)
+
+    try:
+        args.output.write_bytes(convert_session(args.input.read_bytes()))
+    except ValueError as e:
+        print(f"{args.input}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
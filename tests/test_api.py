@@ -0,0 +1,20 @@
+import asyncio
+
+import pytest
+
+from api import evaluate_scenario
+
+
+@pytest.mark.parametrize('scenario, error', [
+    ({'diet': ['Corn silage, typical']}, 'diet must be an object of {feed name: kg DM}'),
+    ({'diet': {'Corn silage, typical': 'ten'}}, "kg DM of 'Corn silage, typical' must be a number"),
+    ({'diet': {'Corn silage, typical': 10}, 'animal_input': {'An_BW': '650'}}, 'An_BW must be a number'),
+    ({'diet': {'Corn silage, typical': 10}, 'equation_selection': [1]}, 'equation_selection must be an object'),
+    ({'diet': {'Corn silage, typical': 10}, 'feed_library': ['NASEM']}, 'Unknown feed library'),
+])
+def test_invalid_scenarios_return_an_error(scenario, error):
+    result = asyncio.run(evaluate_scenario({'id': 'cow 1', **scenario}))
+
+    assert result['id'] == 'cow 1'
+    assert result['status'] == 'error'
+    assert result['error'].startswith(error)
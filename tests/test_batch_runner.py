@@ -0,0 +1,21 @@
+import pyarrow.parquet as pq
+
+from batch_runner import run_batch
+
+
+def test_parquet_output_includes_rows_that_fail_to_parse(tmp_path):
+    scenarios = tmp_path / 'scenarios.csv'
+    scenarios.write_text(
+        'An_BW,diet\n'
+        '650,"{""Corn silage, typical"": 9, ""Urea"": 0.15}"\n'
+        '650,\n'
+        )
+    output = tmp_path / 'results.parquet'
+
+    counts = run_batch(scenarios, output, workers=1)
+
+    assert counts == {'ok': 1, 'error': 1}
+    # Results are written in the order scenarios finish
+    rows = sorted(pq.read_table(output).to_pylist(), key=lambda row: row['scenario_id'])
+    assert [(row['scenario_id'], row['status']) for row in rows] == [('1', 'ok'), ('2', 'error')]
+    assert rows[1]['error'] == 'No diet given for scenario 2'
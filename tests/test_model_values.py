@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from model_values import round_sig_figs
+
+
+@pytest.mark.parametrize('low, high', [(-320, -300), (-30, -10), (-10, 10), (10, 30), (290, 308)])
+def test_round_sig_figs_matches_string_formatting(low, high):
+    rng = np.random.default_rng(0)
+    values = rng.choice([-1, 1], 5000) * 10.0 ** rng.uniform(low, high, 5000)
+
+    expected = [float(f"{value:.4g}") for value in values]
+    assert round_sig_figs(values, 4).tolist() == expected
+
+
+def test_round_sig_figs_keeps_zero_and_non_finite():
+    values = np.array([0.0, np.inf, -np.inf, np.nan, 2.5])
+
+    rounded = round_sig_figs(values, 1)
+    assert rounded[:3].tolist() == [0.0, np.inf, -np.inf]
+    assert np.isnan(rounded[3])
+    assert rounded[4] == float(f"{2.5:.1g}")
@@ -0,0 +1,10 @@
+from search_index import NgramIndex
+
+
+def test_matches_is_a_substring_search_of_each_field():
+    records = [('corn silage', 'forage'), ('soybean meal', 'by-product'), ('corn grain', 'concentrate'), ('', '')]
+    index = NgramIndex(records)
+
+    for keyword in ['c', 'co', 'orn', 'corn', 'corn s', 'meal', 'forage', 'ge', 'silage f', 'xyz', 'n m']:
+        expected = {i for i, record in enumerate(records) if any(keyword in field for field in record)}
+        assert index.matches(keyword) == expected, keyword
@@ -0,0 +1,18 @@
+import pickle
+
+import pytest
+
+import session_file
+
+
+class _RunsCode:
+    def __reduce__(self):
+        return (pytest.fail, ('a legacy session file was unpickled',))
+
+
+def test_legacy_session_files_are_not_unpickled_by_default(monkeypatch):
+    monkeypatch.setattr(session_file, 'allow_legacy_sessions', False)
+    data = pickle.dumps({'ModelOutput': _RunsCode()})
+
+    with pytest.raises(ValueError, match='older version'):
+        session_file.read_session(data)
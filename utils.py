@@ -1,22 +1,59 @@
-from shiny import render
+from shiny import render, reactive
+import math
+import numbers
 import pandas as pd
 import nasem_dairy as nd
 # import sqlite3
 from pathlib import Path
+from functools import cache
+import time
 
+from data_loader import read_csv_cached
+from model_runner import share_feed_library
 
-# load data required
+
+# Data files are loaded on first use (and then shared by all sessions) so that 
+# starting a worker doesn't wait for them
 app_dir = Path(__file__).parent
-var_desc = pd.read_csv(app_dir / "www/variable_descriptions.csv").query("Description != 'Duplicate'")
+default_feed_library_path = app_dir / 'www/FeedLibrary/NASEM_feed_library.csv'
+
+@cache
+def get_var_desc() -> pd.DataFrame:
+    return read_csv_cached(app_dir / "www/variable_descriptions.csv").query("Description != 'Duplicate'")
 
-# Load global resources
-feed_library_default = pd.read_csv(app_dir / 'www/FeedLibrary/NASEM_feed_library.csv').sort_values("Fd_Name")
+@cache
+def get_var_descriptions() -> pd.Series:
+    '''
+    Description of each model variable, indexed by 'Model Variable'. Where a
+    variable is listed more than once, the first description is used.
+    '''
+    var_desc = get_var_desc().drop_duplicates('Model Variable')
+    return var_desc.set_index('Model Variable')['Description']
+
+# Variables that have been reported as not in the model output
+_unknown_vars = set()
+
+def report_unknown_vars(names: list) -> None:
+    '''Prints each variable in `names` that hasn't been reported before'''
+    for name in names:
+        if name not in _unknown_vars:
+            _unknown_vars.add(name)
+            print(f"Value not in ModelOutput: {name}")
+
+@cache
+def get_feed_library_default() -> pd.DataFrame:
+    # Memory-mapped and shared with the model worker processes
+    feed_library = read_csv_cached(default_feed_library_path, sort_by="Fd_Name")
+    share_feed_library(feed_library, default_feed_library_path, sort_by="Fd_Name")
+    return feed_library
 
 # Display results, temporary
 def display_diet_values(model_output = nd.ModelOutput, is_snapshot = False):
     '''
     Takes a dataframe from model output and formats it for better viewing.
     The `is_snapshot` argument allows a shorter version to be returned for the "snapshot" output on Diet page.
+    `model_output` can also be a DietComposition (see feed_matrix.py), where values 
+    that need the model to be run are None.
     '''
     if is_snapshot:
         # 'In' = kg/d (instead of %); RUP/RDP _CP = % of CP; 
@@ -32,15 +69,19 @@ def display_diet_values(model_output = nd.ModelOutput, is_snapshot = False):
 
     rows = []
 
+    def get_rounded_value(name):
+        value = model_output.get_value(name)
+        return round(float(value), 2) if value is not None else None
+
     # Iterate through values and select % and kg information
     for component in components: 
         if component in ['Dt_RDP_CP', 'Dt_RUP_CP', 'Dt_ForNDFIn_percNDF']:
-            percent_diet = round(float(model_output.get_value(component)),2) 
+            percent_diet = get_rounded_value(component)
             kg_diet = None
         else:
-            percent_diet = round(float(model_output.get_value(component)), 2) 
+            percent_diet = get_rounded_value(component)
             # print(type(model_output.get_value(f'{component}In')))
-            kg_diet = round(float(model_output.get_value(f'{component}In')),2)    
+            kg_diet = get_rounded_value(f'{component}In')
 
         rows.append([component, percent_diet, kg_diet])
 
@@ -136,12 +177,199 @@ def get_teaching_feeds() -> list:
         'VitTM Premix, generic'
         ]
 
+def get_output_variables() -> dict:
+    '''
+    Returns a hard-coded dictionary of the model variables shown in each table 
+    of the Outputs tab and the Diet snapshot, keyed by table.
+    '''
+    return {
+        'milk': ['Mlk_Prod_comp', 'MlkFat_Milk_p', 'MlkNP_Milk_p'],
+        'allowable_milk': ['Mlk_Prod_MPalow', 'Mlk_Prod_NEalow'],
+        'ME': ['An_MEIn', 'Trg_MEuse', 'An_NEIn'],
+        'MP': ['An_MPIn', 'An_MPuse_kg_Trg'],
+        'DCAD': ['An_DCADmeq'],
+        'NEL': ['An_NE', 'An_NEIn'],
+        'energy_teaching': [
+            'Trg_MEuse', 'An_MEmUse', 'An_MEgain', 'Gest_MEuse', 'Trg_Mlk_MEout', 
+            'An_MEIn', 'Frm_NEgain', 'Rsrv_NEgain', 'GrUter_BWgain', 'An_MEIn', 
+            'Mlk_Prod_NEalow', 'An_MEavail_Milk'
+            ],
+        'snapshot_lactating': [
+            'Mlk_Prod_comp','MlkFat_Milk_p', 'MlkNP_Milk_p', 'Mlk_Prod_MPalow', 
+            'Mlk_Prod_NEalow', 'An_RDPbal_g', 'Du_MiCP_g'
+            ],
+        'snapshot_dry': [
+            'An_MEIn', 'Trg_MEuse', 'An_MEbal', 'An_MPIn_g', 'An_MPuse_g_Trg', 
+            'An_MPBal_g_Trg','An_RDPIn_g', 'Du_MiCP_g','An_RDPbal_g', 'An_DCADmeq'
+            ],
+    }
+
+
+def get_all_output_variables() -> list:
+    '''Unique variables from get_output_variables(), in the order they are shown in the app'''
+    variables = []
+    for vars_return in get_output_variables().values():
+        variables.extend(v for v in vars_return if v not in variables)
+    return variables
+
+
+def get_default_animal_input() -> dict:
+    '''
+    Returns the animal inputs used by the app when a lactating cow is selected 
+    and nothing has been changed on the Inputs tab. 
+    Used where the model is run without the UI (e.g. batch_runner.py).
+    '''
+    return {
+        'An_Parity_rl': 1.67,
+        'Trg_MilkProd': 35,
+        'An_BW': 700,
+        'An_BCS': 3,
+        'An_LactDay': 100,
+        'Trg_MilkFatp': 3.8,
+        'Trg_MilkTPp': 3.1,
+        'Trg_MilkLacp': 4.85,
+        'Trg_Dt_DMIn': 25,
+        'An_BW_mature': 700,
+        'Trg_FrmGain': 0,
+        'An_GestDay': 46,
+        'An_GestLength': 280,
+        'Trg_RsrvGain': 0,
+        'Fet_BWbrth': 44.1,
+        'An_AgeDay': 1636.2,
+        'An_305RHA_MlkTP': 396,
+        'An_StatePhys': 'Lactating Cow',
+        'An_Breed': 'Holstein',
+        'An_AgeDryFdStart': 14,
+        'Env_TempCurr': 22,
+        'Env_DistParlor': 0,
+        'Env_TripsParlor': 0,
+        'Env_Topo': 0,
+    }
+
+
+def get_default_equation_selection() -> dict:
+    '''
+    Returns the equation selections used by the app by default. 
+    DMIn_eqn is always 0 (i.e. target intake) when the model is run, see NASEM_out() in app.py.
+    '''
+    return {
+        'Use_DNDF_IV': 0,
+        'mProd_eqn': 1,
+        'mPrt_eqn': 1,
+        'mFat_eqn': 1,
+        'Monensin_eqn': 0,
+        'NonMilkCP_ClfLiq': 0,
+        'RumDevDisc_Clf': 0,
+        'MiN_eqn': 1,
+        'DMIn_eqn': 0,
+    }
+
+
+def create_user_diet(feedstuff: list, kg_user: list) -> pd.DataFrame:
+    '''
+    Creates the user_diet DataFrame in the format expected by nd.nasem(),
+    indexed by feed name.
+    '''
+    # dtypes are given so that an empty diet has the same columns
+    user_diet = pd.DataFrame({'Feedstuff': pd.Series(feedstuff, dtype=object), 
+                              'kg_user': pd.Series(kg_user, dtype=float)})
+
+    user_diet['Feedstuff'] = user_diet['Feedstuff'].str.strip()
+    user_diet['Index'] = user_diet['Feedstuff']
+    return user_diet.set_index('Index')
+
+
+def _is_number(value) -> bool:
+    '''True for finite numbers, including numpy numbers but not bools'''
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def build_model_inputs(diet: dict,
+                       animal_input: dict | None = None,
+                       equation_selection: dict | None = None) -> tuple:
+    '''
+    Builds the inputs for nd.nasem() from a diet of {feed name: kg DM} and any
+    animal inputs or equation selections that differ from the app defaults.
+    Trg_Dt_DMIn defaults to the total kg DM of the diet.
+
+    Raises a ValueError for inputs the model doesn't use, so that typos
+    aren't silently replaced by defaults, and for values of the wrong type.
+    '''
+    if not isinstance(diet, dict):
+        raise ValueError("diet must be an object of {feed name: kg DM}")
+    if not diet:
+        raise ValueError("Diet is empty")
+    for feed, kg in diet.items():
+        if not isinstance(feed, str):
+            raise ValueError(f"Feed names in the diet must be text, got {feed!r}")
+        if not _is_number(kg) or kg < 0:
+            raise ValueError(f"kg DM of '{feed}' must be a number of at least 0, got {kg!r}")
+
+    kg_user = [float(kg) for kg in diet.values()]
+    if sum(kg_user) <= 0:
+        raise ValueError("Diet must have more than 0 kg DM")
+
+    model_animal_input = get_default_animal_input()
+    model_animal_input['Trg_Dt_DMIn'] = sum(kg_user)
+    model_equation_selection = get_default_equation_selection()
+
+    for name, value in (('animal_input', animal_input), ('equation_selection', equation_selection)):
+        if value is not None and not isinstance(value, dict):
+            raise ValueError(f"{name} must be an object of {{input: value}}")
+
+    unknown = set(animal_input or {}).difference(model_animal_input)
+    unknown.update(set(equation_selection or {}).difference(model_equation_selection))
+    if unknown:
+        raise ValueError(f"Unknown inputs: {', '.join(sorted(unknown))}")
+
+    for key, value in (animal_input or {}).items():
+        # Text inputs (e.g. An_StatePhys) must stay text, the rest are numbers
+        if isinstance(model_animal_input[key], str):
+            if not isinstance(value, str):
+                raise ValueError(f"{key} must be text, got {value!r}")
+        elif not _is_number(value):
+            raise ValueError(f"{key} must be a number, got {value!r}")
+    for key, value in (equation_selection or {}).items():
+        if not _is_number(value) or value != int(value):
+            raise ValueError(f"{key} must be a whole number, got {value!r}")
+
+    model_animal_input.update(animal_input or {})
+    model_equation_selection.update({k: int(v) for k, v in (equation_selection or {}).items()})
+
+    # target intake is always used, as in the app
+    model_equation_selection['DMIn_eqn'] = 0
+
+    return (
+        create_user_diet(list(diet.keys()), kg_user),
+        model_animal_input,
+        model_equation_selection
+    )
+
+
+def get_model_values(model_output: nd.ModelOutput, variables: list) -> dict:
+    '''
+    Returns {variable: value} for the requested variables, with full precision.
+    Variables that aren't single numbers (e.g. tables) are returned as None.
+    '''
+    values = {}
+    for var in variables:
+        value = model_output.get_value(var)
+        try:
+            values[var] = float(value)
+        except (TypeError, ValueError):
+            values[var] = None
+    return values
+
+
 def rename_df_cols_Fd_to_feed(df: pd.DataFrame) -> pd.DataFrame:
     '''
     Rename columns of the feed df to replace Fd_ with 'Feed_' 
     Takes a df and returns a df.
+    The returned df shares its data with `df` (e.g. the memory-mapped default 
+    library, see data_loader.py) rather than copying it, so it must not be 
+    modified in place.
     '''
-    return df.rename(columns= {col: f'Feed {col[3:]}' if col.startswith('Fd_') else col for col in df.columns} )
+    return df.rename(columns= {col: f'Feed {col[3:]}' if col.startswith('Fd_') else col for col in df.columns}, copy=False)
 
 def DM_intake_equation_strings() -> dict:
     return {
@@ -321,8 +549,9 @@ def pad_cols_UI_df(df: pd.DataFrame,
         for i, col in enumerate(df.columns)
     ]
     
-    df.columns = padded_columns
-    return df
+    # Return a relabelled frame rather than modifying df, which may belong to a 
+    # cached ModelOutput that is rendered again
+    return df.set_axis(padded_columns, axis=1)
 
 def prepare_df_render(df_in, *args, cols_longer = [], use_DataTable = True):
         
@@ -352,7 +581,7 @@ def get_clean_vars(var: str, model_output = nd.ModelOutput):
     model_var = model_output.get_value(var)
     
     if model_var is None:
-        print(f"Value not in ModelOutput: {var}")
+        report_unknown_vars([var])
         return None  
     
     try:
@@ -368,35 +597,68 @@ def get_clean_vars(var: str, model_output = nd.ModelOutput):
 
 def get_vars_as_df(vars_return: list, 
                    model_output: nd.ModelOutput,
-                   var_desc: pd.DataFrame = var_desc) -> pd.DataFrame:
+                   descriptions: pd.Series | None = None) -> pd.DataFrame:
     """
     Create a pandas DataFrame from a list of variable names.
 
     Parameters:
     vars_return (list of str): A list of variable names for which values are to be retrieved.
     model_output (ModelOutput): A ModelOutput from nasem_dairy package
+    descriptions (Series): Variable descriptions, see get_var_descriptions()
 
     Returns:
-    pd.DataFrame: A DataFrame with two columns 'Variable' and 'Value', containing the variable names
-                  and their corresponding values.
+    pd.DataFrame: A DataFrame with the columns 'Model Variable', 'Value' and 'Description'.
     """
 
-    # Create a dictionary with variable names as keys and their corresponding values as float
-    dict_return = {var: get_clean_vars(var, model_output) for var in vars_return}
+    if descriptions is None:
+        descriptions = get_var_descriptions()
 
-    # Convert the dictionary to a DataFrame
-    df = (
-        pd.DataFrame(
-            list(dict_return.items()), 
-            columns=['Model Variable', 'Value']
-            )
-        .merge(var_desc, how = 'left')
+    # Each variable is shown once
+    vars_return = list(dict.fromkeys(vars_return))
+    values = [get_clean_vars(var, model_output) for var in vars_return]
+
+    return pd.DataFrame({
+        'Model Variable': vars_return,
+        'Value': values,
+        'Description': descriptions.reindex(vars_return).to_numpy(),
+        })
+
+
+
+
+
+def get_model_snapshot(model_values, An_StatePhys: str) -> pd.DataFrame:
+    '''
+    A 'snapshot' of the model output, which varies between lactating and 
+    dry cows. Other animal classes could be added here, with similar pattern.
+    `model_values` is a ModelValues (see model_values.py).
+    '''
+    if An_StatePhys == 'Lactating Cow':
+        vars_return = get_output_variables()['snapshot_lactating']
+    elif An_StatePhys == 'Dry Cow':
+        vars_return = get_output_variables()['snapshot_dry']
+    else:
+        return pd.DataFrame()
+
+    return (
+        model_values.get_vars_as_df(vars_return)
+        .drop(columns='Model Variable')
+        .reindex(columns=['Description', 'Value'])
         )
-            
-    return df
 
 
+def compare_animal_inputs(animal_input: dict, model_output: nd.ModelOutput) -> pd.DataFrame:
+    '''
+    The animal inputs given to the model (`animal_input`) next to the animal
+    inputs returned in `model_output`.
+    '''
+    df_user_input_SHINY = pd.DataFrame(animal_input.items(), columns=['Variable Name', 'Value_SHINY'])
+    df_user_input_RETURN = pd.DataFrame(model_output.get_value('animal_input').items(), columns=['Variable Name', 'Value_Model_Return'])
 
+    return df_user_input_SHINY.merge(
+        df_user_input_RETURN,
+        on='Variable Name',
+        how='outer')
 
 
 def contains_text(series):
@@ -415,3 +677,60 @@ def coerce_non_text_to_numeric(df, dp:int = 2):
         if not contains_text(df[column]):
             df[column] = pd.to_numeric(df[column], errors='coerce').round(dp)
     return df
+
+
+##########################################################################################
+# Reactive helpers
+
+def debounce(delay_secs: float):
+    '''
+    Decorator for a reactive function that only passes on a new value once its 
+    dependencies have stopped changing for `delay_secs`. A burst of input changes 
+    (e.g. typing into several kg inputs) therefore only invalidates downstream 
+    reactives once, using the final values.
+
+    Must be used inside a server function, as it creates reactive values and 
+    effects for that session. A delay of 0 returns the function unchanged.
+    '''
+    def wrapper(f):
+        if delay_secs <= 0:
+            return f
+
+        when = reactive.Value(None)
+        trigger = reactive.Value(0)
+
+        @reactive.Calc
+        def cached():
+            return f()
+
+        # Each time f's dependencies change, push the deadline back
+        @reactive.Effect(priority=102)
+        def primer():
+            try:
+                cached()
+            except Exception:
+                # errors (including req()) are raised to callers of the debounced value
+                pass
+            finally:
+                when.set(time.time() + delay_secs)
+
+        @reactive.Effect(priority=101)
+        def timer():
+            deadline = when()
+            if deadline is None:
+                return
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                with reactive.isolate():
+                    when.set(None)
+                    trigger.set(trigger() + 1)
+            else:
+                reactive.invalidate_later(time_left)
+
+        @reactive.Calc
+        @reactive.event(trigger, ignore_none=False)
+        def debounced():
+            return cached()
+
+        return debounced
+    return wrapper
@@ -34,3 +34,145 @@ function toggleUI(UIObjectId, action) {
 Shiny.addCustomMessageHandler("toggleUIHandler", function(message) {
     toggleUI(message.UIObjectId, message.action);
 });
+
+
+
+// Feed dropdowns on the Diet tab only have their selected feed, other feeds are
+// searched on the server (see feed_search_choices() in module_diet.py)
+var feedSearchUrl = null;
+
+Shiny.addCustomMessageHandler("feedSearchUrl", function(message) {
+    feedSearchUrl = message.url;
+});
+
+// Used as the selectize `load` option of the feed dropdowns
+function loadFeedSearch(selectize, query, callback) {
+    if (feedSearchUrl === null) {
+        callback();
+        return;
+    }
+    $.ajax({
+        url: feedSearchUrl,
+        type: "GET",
+        data: {
+            query: query,
+            conju: selectize.settings.searchConjunction,
+            maxop: selectize.settings.maxOptions
+        },
+        error: function() {
+            callback();
+        },
+        success: function(res) {
+            // Feeds are grouped by category
+            res.forEach(function(option) {
+                if (option.optgroup) {
+                    selectize.addOptionGroup(option.optgroup, {value: option.optgroup, label: option.optgroup});
+                }
+            });
+            callback(res);
+        }
+    });
+}
+
+
+
+// Diet editor on the Diet tab. Each row (div.diet-row in div#diet_rows) has a
+// feed dropdown, kg DM and % DM, which aren't Shiny inputs. Changes are sent to
+// the server as a list of edits to rows, by row id, in one input (the input id
+// is in data-input-id, see diet_server() in module_diet.py).
+var pendingDietEdits = {};
+var dietEditsTimer = null;
+
+function sendDietEdits() {
+    clearTimeout(dietEditsTimer);
+    var container = document.getElementById("diet_rows");
+    var edits = Object.values(pendingDietEdits);
+    pendingDietEdits = {};
+    if (container && edits.length > 0) {
+        Shiny.setInputValue(container.dataset.inputId, edits, {priority: "event"});
+    }
+}
+
+// Edits are sent `delay` ms after the last change, with edits to the same row combined
+function addDietEdit(rowEl, edit, delay) {
+    var rowId = rowEl.dataset.rowId;
+    pendingDietEdits[rowId] = Object.assign(pendingDietEdits[rowId] || {row: rowId}, edit);
+    clearTimeout(dietEditsTimer);
+    dietEditsTimer = setTimeout(sendDietEdits, delay);
+}
+
+// % DM of each feed, calculated from the kg DM of each row
+function updateDietPercentages() {
+    var rows = document.querySelectorAll("#diet_rows .diet-row");
+    var kgValues = [];
+    var totalKg = 0;
+    rows.forEach(function(rowEl) {
+        var kg = parseFloat(rowEl.querySelector("input.diet-kg").value);
+        kg = isNaN(kg) ? 0 : kg;
+        kgValues.push(kg);
+        totalKg += kg;
+    });
+    rows.forEach(function(rowEl, i) {
+        // 3 significant figures
+        rowEl.querySelector("input.diet-perc").value =
+            totalKg > 0 ? Number((kgValues[i] / totalKg * 100).toPrecision(3)) : 0;
+    });
+}
+
+// Called after rows are inserted
+function initDietRows() {
+    $("#diet_rows select.diet-feed").not(".selectized").selectize({
+        valueField: "value",
+        labelField: "label",
+        searchField: ["label", "optgroup"],
+        optgroupField: "optgroup",
+        preload: "focus",
+        load: function(query, callback) {
+            loadFeedSearch(this, query, callback);
+        }
+    });
+    updateDietPercentages();
+}
+
+// Used by the server to change a row
+Shiny.addCustomMessageHandler("updateDietRow", function(message) {
+    var rowEl = document.querySelector('#diet_rows .diet-row[data-row-id="' + message.row + '"]');
+    if (!rowEl) {
+        console.error('Diet row not found:', message.row);
+        return;
+    }
+    var selectize = rowEl.querySelector("select.diet-feed").selectize;
+    selectize.addOption({value: message.Feedstuff, label: message.Feedstuff});
+    // silent, so the change isn't sent back to the server
+    selectize.setValue(message.Feedstuff, true);
+    rowEl.querySelector("input.diet-kg").value = message.kg_user;
+    updateDietPercentages();
+});
+
+$(document).on("change", "#diet_rows select.diet-feed", function() {
+    addDietEdit(this.closest(".diet-row"), {Feedstuff: this.value}, 0);
+});
+
+$(document).on("input change", "#diet_rows input.diet-kg", function() {
+    var kg = parseFloat(this.value);
+    addDietEdit(this.closest(".diet-row"), {kg_user: isNaN(kg) ? 0 : kg}, 250);
+    updateDietPercentages();
+});
+
+$(document).on("click", "#diet_rows button.diet-remove", function() {
+    var rowEl = this.closest(".diet-row");
+    addDietEdit(rowEl, {remove: true}, 0);
+    $(rowEl).remove();
+    updateDietPercentages();
+});
+
+
+
+// Sent after the inputs of an uploaded .NDsession have been updated. Replying
+// once the updated values have been sent lets the server run the model once,
+// with all of them (see animal_inputs_server() in module_inputs.py)
+Shiny.addCustomMessageHandler("sessionRestored", function(message) {
+    setTimeout(function() {
+        Shiny.setInputValue(message.id, message.restore, {priority: "event"});
+    }, 0);
+});